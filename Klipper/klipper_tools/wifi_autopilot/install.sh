@@ -6,7 +6,7 @@ echo "========================================"
 # 1. Install Dependencies
 echo "[1/5] Installing dependencies..."
 sudo apt-get update
-sudo apt-get install -y network-manager python3-flask python3-requests wireless-tools iptables
+sudo apt-get install -y network-manager python3-aiohttp python3-brotli python3-requests python3-jeepney wireless-tools iptables
 
 # 2. Stop existing service if running
 echo "[2/5] Stopping existing service..."
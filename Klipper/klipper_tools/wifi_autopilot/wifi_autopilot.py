@@ -1,8 +1,21 @@
 #!/usr/bin/env python3
 """
-Klipper Wi-Fi Autopilot - v3.2
+Klipper Wi-Fi Autopilot - v3.3
 Monitors Wi-Fi and provides a captive portal for easy setup.
 
+v3.3 Changes:
+- Event-driven monitor: checks when NetworkManager or the kernel report a change
+- wifi_autopilot_bench.py --simulate runs the monitor against fake outages and reports detection latency
+- Connectivity probes are concurrent TCP connects within a time budget, no ping processes
+- wifi_autopilot_bench.py --bench-probes reports probe latency and CPU
+- Wi-Fi scans run in the background, /scan answers from a cache and /scan/events pushes new results
+- LCD messages are queued and sent by a notifier thread over one keep-alive connection
+- Talks to NetworkManager over one D-Bus connection (python3-jeepney) and follows its signals, nmcli remains the fallback
+- wifi_autopilot_bench.py --test-dbus runs the D-Bus client against a fake NetworkManager on a private bus
+- The portal runs on aiohttp: connecting is a background job with /connect/status and /connect/events
+- The page is encoded once at startup (gzip, brotli with python3-brotli) and served with ETag and Cache-Control
+- /metrics in Prometheus text format and /health for the monitor thread
+
 v3.2 Changes:
 - Removed wifi_status.cfg dependency - sends M117 directly
 - Simplified installation (no macro needed)
@@ -14,37 +27,163 @@ import requests
 import logging
 import threading
 import os
-from flask import Flask, jsonify, request, render_template_string, redirect
+import queue
+import socket
+import struct
+import argparse
+import selectors
+import errno
+import json
+import re
+import asyncio
+import gzip
+import hashlib
+from aiohttp import web
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from jeepney import DBusAddress, DBusErrorResponse, MatchRule, MessageType, new_method_call
+    from jeepney.bus_messages import message_bus
+    from jeepney.io.blocking import open_dbus_connection
+    from jeepney.wrappers import unwrap_msg
+except ImportError:
+    open_dbus_connection = None
 
 # --- CONFIGURATION ---
-CHECK_INTERVAL = 10          # Seconds between checks
-PING_TARGETS = ["8.8.8.8", "1.1.1.1", "208.67.222.222"]  # Multiple DNS servers
+CHECK_INTERVAL = 60          # Seconds between checks when no network event arrives
+CONFIRM_INTERVAL = 2         # Seconds between checks while an outage or recovery is being confirmed
+EVENT_SETTLE = 0.5           # Seconds to collect the burst of events that follows a change
+BOOT_DELAY = 20              # Seconds to wait for the system to boot before monitoring
+HEALTH_MAX_AGE = 3 * CHECK_INTERVAL  # Seconds without a check before /health reports the monitor stuck
+PROBE_TARGETS = [("8.8.8.8", 53), ("1.1.1.1", 443), ("208.67.222.222", 53)]  # (host, TCP port), probed together
+PROBE_BUDGET = 2.0           # Seconds for the probes before the check counts as offline
 HOTSPOT_SSID = "Klipper-Setup"
 HOTSPOT_PASSWORD = ""        # Leave empty for open network, or set a password (min 8 chars)
 MOONRAKER_API = "http://127.0.0.1:7125"
+NOTIFY_QUEUE_SIZE = 8        # LCD messages waiting for Moonraker, the oldest are dropped
+NOTIFY_MAX_AGE = 120         # Seconds an LCD message is retried while Moonraker is unreachable
 OFFLINE_THRESHOLD = 2        # Failed checks before hotspot
 ONLINE_THRESHOLD = 2         # Successful checks before disabling hotspot
-FLASK_PORT = 8888            # Port for Flask (not 80 to avoid nginx conflict)
+PORTAL_PORT = 8888           # Port for the portal (not 80 to avoid nginx conflict)
 HOTSPOT_INTERFACE = "wlan0"
+SCAN_TTL = 30                # Seconds scan results are served before /scan starts a new scan
+SCAN_SETTLE = 3              # Seconds NetworkManager needs to collect results after a rescan
+CONNECT_TIMEOUT = 30         # Seconds to wait for a connection to come up
+CONNECT_DELAY = 1            # Seconds between answering /connect and taking the hotspot down
+DBUS_TIMEOUT = 10            # Seconds to wait for a NetworkManager D-Bus reply
 
 # State
 hotspot_active = False
 offline_count = 0
 online_count = 0
+outage_start = None          # time.monotonic() of the first failed check of the current outage
+offline_seconds = 0.0        # length of the outages that ended
+last_check = None            # time.monotonic() of the last check by the monitor loop
+started = time.monotonic()
+events = queue.Queue()       # (source, detail) of network changes, wakes the monitor loop
+scan_results = []            # [{"ssid", "signal", "security"}], strongest first
+scan_time = None             # time.monotonic() of the last finished scan
+scan_generation = 0          # counts finished scans, for /scan/events
+scan_requested = False
+scan_running = False
+scan_changed = threading.Condition()  # guards the scan_ state
+scan_listeners = []          # called after every scan, from the scanner thread
+notify_queue = queue.Queue(maxsize=NOTIFY_QUEUE_SIZE)  # (time.monotonic(), message) for the LCD
 
-# Logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(message)s',
-    handlers=[
-        logging.StreamHandler(),
-        logging.FileHandler('/var/log/wifi_autopilot.log')
-    ]
-)
+# rtnetlink (linux/rtnetlink.h)
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+RTM_NAMES = {16: "new link", 17: "link removed", 20: "new address", 21: "address removed",
+             24: "new route", 25: "route removed"}
+IFF_LINK_STATE = 0x40 | 0x10000  # IFF_RUNNING | IFF_LOWER_UP
+IFF_LOOPBACK = 0x8
+
+# Logging, set up by main() so importing the module leaves the log file alone
+LOG_FILE = "/var/log/wifi_autopilot.log"
+LOG_FORMAT = "%(asctime)s [%(levelname)s] %(message)s"
 log = logging.getLogger("wifi_autopilot")
 
-# --- FLASK APP ---
-app = Flask(__name__)
+
+# --- METRICS ---
+class Metrics:
+    """Counters and histograms for /metrics, in the Prometheus text format. Safe to update from any thread."""
+    
+    def __init__(self, definitions):
+        self.definitions = definitions  # name: (type, help) or ("histogram", help, buckets)
+        self.values = {}                # (name, labels): counter value or [bucket counts..., sum, count]
+        self.gauges = []                # functions returning (name, labels, value) lines at scrape time
+        self.lock = threading.Lock()
+    
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+    
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        buckets = self.definitions[name][2]
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(buckets) + 2))
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+    
+    def render(self):
+        def labels(pairs):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}" if pairs else ""
+        
+        samples = {}
+        with self.lock:
+            for (name, pairs), value in self.values.items():
+                samples.setdefault(name, []).append((pairs, value if isinstance(value, (int, float)) else list(value)))
+        for gauge in self.gauges:
+            for name, pairs, value in gauge():
+                samples.setdefault(name, []).append((tuple(sorted(pairs.items())), value))
+        
+        lines = []
+        for name, (kind, text, *buckets) in self.definitions.items():
+            lines += [f"# HELP {name} {text}", f"# TYPE {name} {kind}"]
+            for pairs, value in sorted(samples.get(name, [])):
+                if kind != "histogram":
+                    lines.append(f"{name}{labels(pairs)} {value}")
+                    continue
+                for bound, count in zip(list(buckets[0]) + ["+Inf"], value[:-2] + [value[-1]]):
+                    lines.append(f"{name}_bucket{labels(pairs + (('le', f'{bound:g}' if bound != '+Inf' else bound),))} {count}")
+                lines.append(f"{name}_sum{labels(pairs)} {value[-2]}")
+                lines.append(f"{name}_count{labels(pairs)} {value[-1]}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics({
+    "wifi_autopilot_check_seconds": ("histogram", "Connectivity checks of the monitor loop by result",
+                                     (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 5)),
+    "wifi_autopilot_outage_seconds": ("histogram", "Outages from the first failed check to the first good one",
+                                      (10, 30, 60, 300, 900, 3600, 14400, 86400)),
+    "wifi_autopilot_offline_seconds_total": ("counter", "Time spent offline, the current outage included"),
+    "wifi_autopilot_offline": ("gauge", "1 while the last check failed"),
+    "wifi_autopilot_hotspot_active": ("gauge", "1 while the setup hotspot is up"),
+    "wifi_autopilot_hotspot_transitions_total": ("counter", "Hotspot changes by new state, failed to come up included"),
+    "wifi_autopilot_network_events_total": ("counter", "Network change events by source"),
+    "wifi_autopilot_scan_seconds": ("histogram", "Wi-Fi scans", (0.5, 1, 2, 3, 5, 10, 20)),
+    "wifi_autopilot_call_seconds": ("histogram", "NetworkManager and system calls by kind, subprocess or D-Bus",
+                                    (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)),
+    "wifi_autopilot_connect_total": ("counter", "Portal connect jobs by result"),
+    "wifi_autopilot_lcd_messages_total": ("counter", "LCD messages by outcome"),
+    "wifi_autopilot_queue_depth": ("gauge", "Items waiting in the internal queues"),
+    "wifi_autopilot_last_check_age_seconds": ("gauge", "Time since the monitor loop last checked"),
+    "process_cpu_seconds_total": ("counter", "User and system CPU time of the autopilot, its child processes included"),
+    "process_resident_memory_bytes": ("gauge", "Resident memory of the autopilot"),
+})
+
+# --- WEB PORTAL ---
+routes = web.RouteTableDef()
 
 HTML_TEMPLATE = """
 <!DOCTYPE html>
@@ -96,25 +235,28 @@ HTML_TEMPLATE = """
             s.classList.remove('hidden');
         }
 
-        function scan() {
+        function render(data) {
+            const div = document.getElementById('scan-results');
+            div.innerHTML = "";
+            if(data.networks.length === 0) {
+                div.innerHTML = data.scanning ? '<p class="loading">Scanning...</p>'
+                    : "<p>No networks found. <button onclick='scan(true)'>Retry</button></p>";
+                return;
+            }
+            data.networks.forEach(net => {
+                if(!net.ssid || net.ssid === 'Klipper-Setup') return;
+                let btn = document.createElement('div');
+                btn.className = 'network';
+                btn.innerText = '📶 ' + net.ssid + ' (' + net.signal + '%)' + (net.security ? ' 🔒' : '');
+                btn.onclick = () => select(net.ssid);
+                div.appendChild(btn);
+            });
+        }
+
+        function scan(refresh) {
             document.getElementById('scan-results').innerHTML = '<p class="loading">Scanning...</p>';
-            fetch('/scan').then(r => r.json()).then(data => {
-                const div = document.getElementById('scan-results');
-                div.innerHTML = "";
-                if(data.networks.length === 0) {
-                    div.innerHTML = "<p>No networks found. <button onclick='scan()'>Retry</button></p>";
-                    return;
-                }
-                data.networks.forEach(ssid => {
-                    if(!ssid || ssid === 'Klipper-Setup') return;
-                    let btn = document.createElement('div');
-                    btn.className = 'network';
-                    btn.innerText = '📶 ' + ssid;
-                    btn.onclick = () => select(ssid);
-                    div.appendChild(btn);
-                });
-            }).catch(() => {
-                document.getElementById('scan-results').innerHTML = "<p>Scan failed. <button onclick='scan()'>Retry</button></p>";
+            fetch(refresh ? '/scan?refresh=1' : '/scan').then(r => r.json()).then(render).catch(() => {
+                document.getElementById('scan-results').innerHTML = "<p>Scan failed. <button onclick='scan(true)'>Retry</button></p>";
             });
         }
 
@@ -130,7 +272,7 @@ HTML_TEMPLATE = """
         function cancel() {
             document.getElementById('connect-form').classList.add('hidden');
             document.getElementById('scan-results').classList.remove('hidden');
-            scan();
+            scan(true);
         }
 
         function connect() {
@@ -140,16 +282,47 @@ HTML_TEMPLATE = """
                 method: 'POST',
                 headers: {'Content-Type': 'application/json'},
                 body: JSON.stringify({ssid: selectedSSID, password: pw})
-            }).then(r => r.json()).then(d => {
-                if(d.success) {
+            }).then(r => r.json()).then(job => {
+                if(job.state !== 'connecting') {
+                    showStatus('❌ Failed: ' + job.message, 'error');
+                    return;
+                }
+                showConnecting(job);
+                watch(job.id);
+            }).catch(() => showStatus('Connection error. Please try again.', 'error'));
+        }
+
+        function showConnecting(job) {
+            showStatus('Connecting to ' + job.ssid + '... The setup hotspot turns off while the printer connects. ' +
+                       'If it comes back, join it again to see what went wrong.', 'loading');
+        }
+
+        // the hotspot goes down while connecting, requests fail until it is back or the phone moved on
+        function watch(id) {
+            fetch('/connect/status').then(r => r.json()).then(job => {
+                if(job.id !== id) return;
+                if(job.state === 'connected') {
                     showStatus('✅ Connected! The printer is now online. This page will close.', 'success');
+                } else if(job.state === 'failed') {
+                    showStatus('❌ Failed: ' + job.message, 'error');
                 } else {
-                    showStatus('❌ Failed: ' + d.message, 'error');
+                    setTimeout(() => watch(id), 2000);
                 }
-            }).catch(() => showStatus('Connection error. Please try again.', 'error'));
+            }).catch(() => setTimeout(() => watch(id), 2000));
         }
 
         scan();
+        fetch('/connect/status').then(r => r.json()).then(job => {
+            if(job.state === 'failed') {
+                showStatus('❌ Could not connect to ' + job.ssid + ': ' + job.message, 'error');
+            } else if(job.state === 'connecting') {
+                showConnecting(job);
+                watch(job.id);
+            }
+        });
+        if(window.EventSource) {
+            new EventSource('/scan/events').onmessage = e => render(JSON.parse(e.data));
+        }
     </script>
 </body>
 </html>
@@ -158,66 +331,409 @@ HTML_TEMPLATE = """
 
 def run_cmd(cmd, timeout=15):
     """Run shell command and return output."""
+    start = time.monotonic()
     try:
         result = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=timeout)
         return result.stdout.strip(), result.returncode
     except Exception as e:
         log.error(f"Command failed: {cmd} - {e}")
         return "", -1
+    finally:
+        metrics.observe("wifi_autopilot_call_seconds", time.monotonic() - start, kind="subprocess",
+                        command=cmd.split()[0] if cmd.split() else "")
 
 
-def is_connected():
-    """Check internet connectivity by pinging multiple targets."""
-    for target in PING_TARGETS:
-        try:
-            result = subprocess.run(
-                ["ping", "-c", "1", "-W", "2", target],
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.DEVNULL,
-                timeout=5
-            )
-            if result.returncode == 0:
+def is_connected(targets=None, budget=None):
+    """Check internet connectivity with concurrent TCP connects - the first to succeed wins."""
+    targets = PROBE_TARGETS if targets is None else targets
+    deadline = time.monotonic() + (PROBE_BUDGET if budget is None else budget)
+    selector = selectors.DefaultSelector()
+    try:
+        for host, port in targets:
+            sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+            sock.setblocking(False)
+            result = sock.connect_ex((host, port))
+            if result == 0:
+                sock.close()
                 return True
-        except:
-            continue
-    return False
+            if result in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                selector.register(sock, selectors.EVENT_WRITE)
+            else:
+                sock.close()  # no route, no address on the interface
+        
+        while selector.get_map() and (remaining := deadline - time.monotonic()) > 0:
+            for key, _ in selector.select(remaining):
+                selector.unregister(key.fileobj)
+                # refused counts as offline too, captive and firewalled networks answer with a reset
+                connected = key.fileobj.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0
+                key.fileobj.close()
+                if connected:
+                    return True
+        return False
+    finally:
+        for key in list(selector.get_map().values()):
+            key.fileobj.close()
+        selector.close()
+
+
+# --- NETWORKMANAGER ---
+NM_BUS = "org.freedesktop.NetworkManager"
+NM_PATH = "/org/freedesktop/NetworkManager"
+NM_SETTINGS_PATH = "/org/freedesktop/NetworkManager/Settings"
+NM_DEVICE = "org.freedesktop.NetworkManager.Device"
+NM_WIRELESS = "org.freedesktop.NetworkManager.Device.Wireless"
+NM_ACCESS_POINT = "org.freedesktop.NetworkManager.AccessPoint"
+NM_ACTIVE = "org.freedesktop.NetworkManager.Connection.Active"
+NM_SETTINGS = "org.freedesktop.NetworkManager.Settings"
+NM_CONNECTION = "org.freedesktop.NetworkManager.Settings.Connection"
+DBUS_PROPERTIES = "org.freedesktop.DBus.Properties"
+NM_ACTIVATED, NM_DEACTIVATED = 2, 4
+NM_FAILURE_REASONS = {7: "Password required", 8: "Authentication failed, check the password",
+                      9: "Authentication failed, check the password", 53: "Network not found"}
+NM_WATCHED = {"State", "Connectivity", "PrimaryConnection", "ActiveConnections", "ActiveAccessPoint", "Ip4Config"}
+
+
+class ShellNetworkManager:
+    """NetworkManager through nmcli and iwgetid, a process for every call."""
+    name = "nmcli"
+    
+    def current_ssid(self):
+        output, _ = run_cmd("iwgetid -r")
+        return output or None
+    
+    def rescan(self, wait=True):
+        run_cmd("nmcli dev wifi rescan")
+        if wait:
+            time.sleep(SCAN_SETTLE)
+    
+    def access_points(self):
+        """(ssid, signal, security) of every access point seen, security "" when open."""
+        output, _ = run_cmd("nmcli -t -f SSID,SIGNAL,SECURITY dev wifi list")
+        for line in output.split('\n'):
+            # terse output escapes ':' and '\' in values with a backslash
+            match = re.match(r'((?:\\.|[^\\:])*):(\d*):(.*)$', line)
+            if match:
+                ssid, signal, security = (re.sub(r'\\(.)', r'\1', x) for x in match.groups())
+                yield ssid, int(signal or 0), "" if security == "--" else security
+    
+    def connect(self, ssid, password):
+        if password:
+            cmd = f"nmcli dev wifi connect '{ssid}' password '{password}'"
+        else:
+            cmd = f"nmcli dev wifi connect '{ssid}'"
+        output, code = run_cmd(cmd, timeout=CONNECT_TIMEOUT)
+        return code == 0 or "successfully" in output.lower(), output
+    
+    def remove_hotspot(self):
+        run_cmd(f"nmcli con down '{HOTSPOT_SSID}' 2>/dev/null")
+        run_cmd(f"nmcli con delete '{HOTSPOT_SSID}' 2>/dev/null")
+    
+    def add_hotspot(self):
+        if HOTSPOT_PASSWORD and len(HOTSPOT_PASSWORD) >= 8:
+            # Protected hotspot with password
+            output, code = run_cmd(
+                f"nmcli dev wifi hotspot ifname {HOTSPOT_INTERFACE} ssid '{HOTSPOT_SSID}' password '{HOTSPOT_PASSWORD}'"
+            )
+        else:
+            # Open network - must create connection manually
+            # First, create an AP-mode connection without security
+            run_cmd(f"nmcli con add type wifi ifname {HOTSPOT_INTERFACE} con-name '{HOTSPOT_SSID}' ssid '{HOTSPOT_SSID}' mode ap")
+            run_cmd(f"nmcli con modify '{HOTSPOT_SSID}' wifi-sec.key-mgmt none")
+            run_cmd(f"nmcli con modify '{HOTSPOT_SSID}' ipv4.method shared")
+            run_cmd(f"nmcli con modify '{HOTSPOT_SSID}' ipv4.addresses 10.42.0.1/24")
+            output, code = run_cmd(f"nmcli con up '{HOTSPOT_SSID}'")
+        return code == 0, output
+    
+    def autoconnect(self):
+        run_cmd(f"nmcli dev set {HOTSPOT_INTERFACE} autoconnect yes")
+    
+    def watch(self, report):
+        """Call report() with every line of nmcli monitor, restarting it when it exits."""
+        while True:
+            try:
+                proc = subprocess.Popen(["nmcli", "monitor"], stdout=subprocess.PIPE,
+                                        stderr=subprocess.DEVNULL, text=True)
+            except FileNotFoundError:
+                log.warning("nmcli not found, relying on netlink and polling")
+                return
+            for line in proc.stdout:
+                if line.strip():
+                    report(line.strip())
+            proc.wait()
+            log.debug(f"nmcli monitor exited ({proc.returncode}), restarting")
+            time.sleep(5)
+
+
+class DBusNetworkManager:
+    """NetworkManager over one D-Bus connection, shared by all threads."""
+    name = "D-Bus"
+    
+    def __init__(self, bus="SYSTEM"):
+        self.bus = bus
+        self.conn = None
+        self.lock = threading.Lock()
+        self.device = self.call(NM_PATH, NM_BUS, "GetDeviceByIpIface", "s", HOTSPOT_INTERFACE)[0]
+    
+    def call(self, path, interface, method, signature=None, *args):
+        message = new_method_call(DBusAddress(path, NM_BUS, interface), method, signature, args)
+        start = time.monotonic()
+        with self.lock:
+            try:
+                if self.conn is None:
+                    self.conn = open_dbus_connection(self.bus)
+                reply = self.conn.send_and_get_reply(message, timeout=DBUS_TIMEOUT)
+            except (OSError, TimeoutError):
+                # a restarted bus or a reply that never came, the next call starts over
+                if self.conn is not None:
+                    self.conn.close()
+                self.conn = None
+                raise
+            finally:
+                metrics.observe("wifi_autopilot_call_seconds", time.monotonic() - start, kind="dbus", command=method)
+        return unwrap_msg(reply)
+    
+    def get(self, path, interface, name):
+        return self.call(path, DBUS_PROPERTIES, "Get", "ss", interface, name)[0][1]
+    
+    def current_ssid(self):
+        ap = self.get(self.device, NM_WIRELESS, "ActiveAccessPoint")
+        return bytes(self.get(ap, NM_ACCESS_POINT, "Ssid")).decode("utf8", "replace") if ap != "/" else None
+    
+    def rescan(self, wait=True):
+        last_scan = self.get(self.device, NM_WIRELESS, "LastScan")
+        try:
+            self.call(self.device, NM_WIRELESS, "RequestScan", "a{sv}", {})
+        except DBusErrorResponse as e:
+            log.debug(f"Rescan refused: {e}")  # scanned moments ago, or in AP mode
+            return
+        # NetworkManager stamps LastScan when the results are in
+        deadline = time.monotonic() + SCAN_SETTLE
+        while wait and time.monotonic() < deadline and self.get(self.device, NM_WIRELESS, "LastScan") == last_scan:
+            time.sleep(0.1)
+    
+    def access_points(self):
+        for ap in self.call(self.device, NM_WIRELESS, "GetAllAccessPoints")[0]:
+            props = {k: v[1] for k, v in self.call(ap, DBUS_PROPERTIES, "GetAll", "s", NM_ACCESS_POINT)[0].items()}
+            # named the way nmcli does: NM_802_11_AP_FLAGS_PRIVACY and NM_802_11_AP_SEC_KEY_MGMT_*
+            wpa, rsn = props["WpaFlags"], props["RsnFlags"]
+            security = []
+            if props["Flags"] & 0x1 and not wpa and not rsn:
+                security.append("WEP")
+            if wpa:
+                security.append("WPA1")
+            if rsn & 0x300 or (rsn and not rsn & 0x400):
+                security.append("WPA2")
+            if rsn & 0x400:
+                security.append("WPA3")
+            if (wpa | rsn) & 0x200:
+                security.append("802.1X")
+            yield bytes(props["Ssid"]).decode("utf8", "replace"), props["Strength"], " ".join(security)
+    
+    def activate(self, settings, specific_object="/"):
+        """Add a connection and bring it up, False and the reason when it does not come up."""
+        try:
+            connection, active = self.call(NM_PATH, NM_BUS, "AddAndActivateConnection", "a{sa{sv}}oo",
+                                           settings, self.device, specific_object)
+        except DBusErrorResponse as e:
+            return False, str(e.data[0]) if e.data else e.name
+        
+        deadline = time.monotonic() + CONNECT_TIMEOUT
+        state = None
+        while time.monotonic() < deadline:
+            try:
+                state = self.get(active, NM_ACTIVE, "State")
+            except DBusErrorResponse:
+                state = NM_DEACTIVATED  # gone with its connection
+            if state in (NM_ACTIVATED, NM_DEACTIVATED):
+                break
+            time.sleep(0.2)
+        if state == NM_ACTIVATED:
+            return True, "Connected"
+        
+        # as nmcli does, a connection that never came up is not kept
+        reason = self.get(self.device, NM_DEVICE, "StateReason")[1]
+        try:
+            self.call(connection, NM_CONNECTION, "Delete")
+        except DBusErrorResponse:
+            pass
+        return False, NM_FAILURE_REASONS.get(reason, f"Activation failed (reason {reason})")
+    
+    def connect(self, ssid, password):
+        strongest, signal = "/", -1
+        for ap in self.call(self.device, NM_WIRELESS, "GetAllAccessPoints")[0]:
+            props = self.call(ap, DBUS_PROPERTIES, "GetAll", "s", NM_ACCESS_POINT)[0]
+            if bytes(props["Ssid"][1]).decode("utf8", "replace") == ssid and props["Strength"][1] > signal:
+                strongest, signal = ap, props["Strength"][1]
+        settings = {"802-11-wireless": {"ssid": ("ay", ssid.encode("utf8"))}}
+        if password:
+            settings["802-11-wireless-security"] = {"key-mgmt": ("s", "wpa-psk"), "psk": ("s", password)}
+        return self.activate(settings, strongest)
+    
+    def remove_hotspot(self):
+        # deleting an active connection takes it down too
+        for connection in self.call(NM_SETTINGS_PATH, NM_SETTINGS, "ListConnections")[0]:
+            settings = self.call(connection, NM_CONNECTION, "GetSettings")[0]
+            if settings["connection"]["id"][1] == HOTSPOT_SSID:
+                self.call(connection, NM_CONNECTION, "Delete")
+    
+    def add_hotspot(self):
+        settings = {
+            "connection": {"id": ("s", HOTSPOT_SSID), "type": ("s", "802-11-wireless"),
+                           "interface-name": ("s", HOTSPOT_INTERFACE)},
+            "802-11-wireless": {"ssid": ("ay", HOTSPOT_SSID.encode("utf8")), "mode": ("s", "ap")},
+            "ipv4": {"method": ("s", "shared"),
+                     "address-data": ("aa{sv}", [{"address": ("s", "10.42.0.1"), "prefix": ("u", 24)}])},
+        }
+        if HOTSPOT_PASSWORD and len(HOTSPOT_PASSWORD) >= 8:
+            settings["802-11-wireless-security"] = {
+                "key-mgmt": ("s", "wpa-psk"), "psk": ("s", HOTSPOT_PASSWORD),
+                "proto": ("as", ["rsn"]), "pairwise": ("as", ["ccmp"]), "group": ("as", ["ccmp"])}
+        return self.activate(settings)
+    
+    def autoconnect(self):
+        self.call(self.device, DBUS_PROPERTIES, "Set", "ssv", NM_DEVICE, "Autoconnect", ("b", True))
+    
+    def watch(self, report):
+        """Call report() with every NetworkManager state and connectivity change, from its signals.
+        
+        Runs on a connection of its own, the shared one only waits for replies.
+        """
+        rules = [MatchRule(type="signal", sender=NM_BUS, member="StateChanged"),
+                 MatchRule(type="signal", sender=NM_BUS, interface=DBUS_PROPERTIES, member="PropertiesChanged",
+                           path=NM_PATH),
+                 MatchRule(type="signal", sender=NM_BUS, interface=DBUS_PROPERTIES, member="PropertiesChanged",
+                           path=self.device)]
+        while True:
+            conn = None
+            try:
+                conn = open_dbus_connection(self.bus)
+                for rule in rules:
+                    conn.send_and_get_reply(message_bus.AddMatch(rule), timeout=DBUS_TIMEOUT)
+                while True:
+                    msg = conn.receive()
+                    if msg.header.message_type != MessageType.signal:
+                        continue
+                    fields = msg.header.fields
+                    path, member = fields[1], fields[3]
+                    if member == "StateChanged":
+                        report(f"{path} state {msg.body[0]}")
+                    elif member == "PropertiesChanged":
+                        # access point lists and scan stamps change all the time, only the state counts
+                        changed = NM_WATCHED.intersection(msg.body[1])
+                        if changed:
+                            report(f"{path} {', '.join(sorted(changed))} changed")
+            except (OSError, TimeoutError) as e:
+                log.debug(f"NetworkManager signals lost ({e}), subscribing again")
+            finally:
+                if conn is not None:
+                    conn.close()
+            time.sleep(5)
+
+
+def open_network_manager():
+    """The D-Bus client when NetworkManager answers on the system bus, nmcli otherwise."""
+    if open_dbus_connection is None:
+        log.info("python3-jeepney not installed, using nmcli")
+        return ShellNetworkManager()
+    try:
+        return DBusNetworkManager()
+    except Exception as e:
+        log.warning(f"NetworkManager not reachable over D-Bus, using nmcli: {e}")
+        return ShellNetworkManager()
+
+
+nm = ShellNetworkManager()   # replaced by open_network_manager() at startup
 
 
 def get_current_ssid():
     """Get current connected SSID."""
-    output, _ = run_cmd("iwgetid -r")
-    return output if output and output != HOTSPOT_SSID else None
+    try:
+        ssid = nm.current_ssid()
+    except Exception as e:
+        log.error(f"SSID query failed: {e}")
+        return None
+    return ssid if ssid and ssid != HOTSPOT_SSID else None
 
 
 def klipper_msg(msg):
-    """Send message to Klipper LCD via M117 directly."""
-    try:
-        response = requests.post(
-            f"{MOONRAKER_API}/printer/gcode/script",
-            json={"script": f'M117 {msg}'},
-            timeout=5
-        )
-        if response.status_code == 200:
-            log.info(f"LCD: {msg}")
-        else:
-            log.warning(f"LCD failed (status {response.status_code}): {response.text}")
-    except requests.exceptions.ConnectionError:
-        log.debug("LCD: Moonraker not reachable (normal during boot)")
-    except Exception as e:
-        log.warning(f"LCD message failed: {e}")
+    """Queue a message for the Klipper LCD (M117), returns at once."""
+    while True:
+        try:
+            notify_queue.put_nowait((time.monotonic(), msg))
+            return
+        except queue.Full:
+            try:
+                notify_queue.get_nowait()  # M117 shows the newest message only
+                metrics.inc("wifi_autopilot_lcd_messages_total", result="replaced")
+            except queue.Empty:
+                pass
+
+
+def notifier_loop():
+    """Send queued LCD messages to Moonraker - runs in background thread."""
+    session = requests.Session()
+    shown = None
+    
+    while True:
+        queued, msg = notify_queue.get()
+        # M117 replaces the line on the display, of a backlog only the newest message matters
+        while not notify_queue.empty():
+            queued, msg = notify_queue.get_nowait()
+            metrics.inc("wifi_autopilot_lcd_messages_total", result="replaced")
+        if msg == shown:
+            metrics.inc("wifi_autopilot_lcd_messages_total", result="already_shown")
+            continue
+        
+        retry = 1
+        while True:
+            try:
+                response = session.post(
+                    f"{MOONRAKER_API}/printer/gcode/script",
+                    json={"script": f'M117 {msg}'},
+                    timeout=(2, 5)
+                )
+                if response.status_code == 200:
+                    log.info(f"LCD: {msg}")
+                    shown = msg
+                    metrics.inc("wifi_autopilot_lcd_messages_total", result="sent")
+                else:
+                    log.warning(f"LCD failed (status {response.status_code}): {response.text}")
+                    metrics.inc("wifi_autopilot_lcd_messages_total", result="failed")
+                break
+            except requests.exceptions.ConnectionError:
+                log.debug("LCD: Moonraker not reachable (normal during boot)")
+            except Exception as e:
+                log.warning(f"LCD message failed: {e}")
+                metrics.inc("wifi_autopilot_lcd_messages_total", result="failed")
+                break
+            # wait for Moonraker, a newer message replaces this one
+            if time.monotonic() - queued > NOTIFY_MAX_AGE:
+                log.info(f"LCD: gave up on '{msg}', Moonraker not reachable")
+                metrics.inc("wifi_autopilot_lcd_messages_total", result="expired")
+                break
+            try:
+                queued, msg = notify_queue.get(timeout=retry)
+            except queue.Empty:
+                retry = min(retry * 2, 30)
+                continue
+            metrics.inc("wifi_autopilot_lcd_messages_total", result="replaced")
+            while not notify_queue.empty():
+                queued, msg = notify_queue.get_nowait()
+                metrics.inc("wifi_autopilot_lcd_messages_total", result="replaced")
+            retry = 1
 
 
 def setup_iptables_redirect():
-    """Redirect port 80 to Flask port when in hotspot mode."""
-    run_cmd(f"iptables -t nat -A PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 80 -j REDIRECT --to-port {FLASK_PORT}")
-    run_cmd(f"iptables -t nat -A PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 443 -j REDIRECT --to-port {FLASK_PORT}")
+    """Redirect port 80 to the portal port when in hotspot mode."""
+    run_cmd(f"iptables -t nat -A PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 80 -j REDIRECT --to-port {PORTAL_PORT}")
+    run_cmd(f"iptables -t nat -A PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 443 -j REDIRECT --to-port {PORTAL_PORT}")
     log.info("iptables redirect enabled")
 
 
 def remove_iptables_redirect():
     """Remove port 80 redirect."""
-    run_cmd(f"iptables -t nat -D PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 80 -j REDIRECT --to-port {FLASK_PORT}")
-    run_cmd(f"iptables -t nat -D PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 443 -j REDIRECT --to-port {FLASK_PORT}")
+    run_cmd(f"iptables -t nat -D PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 80 -j REDIRECT --to-port {PORTAL_PORT}")
+    run_cmd(f"iptables -t nat -D PREROUTING -i {HOTSPOT_INTERFACE} -p tcp --dport 443 -j REDIRECT --to-port {PORTAL_PORT}")
     log.info("iptables redirect removed")
 
 
@@ -228,28 +744,20 @@ def enable_hotspot():
     log.info("=== ENABLING HOTSPOT ===")
     
     # Remove any existing hotspot
-    run_cmd(f"nmcli con down '{HOTSPOT_SSID}' 2>/dev/null")
-    run_cmd(f"nmcli con delete '{HOTSPOT_SSID}' 2>/dev/null")
-    time.sleep(1)
-    
-    # Create hotspot
-    if HOTSPOT_PASSWORD and len(HOTSPOT_PASSWORD) >= 8:
-        # Protected hotspot with password
-        output, code = run_cmd(
-            f"nmcli dev wifi hotspot ifname {HOTSPOT_INTERFACE} ssid '{HOTSPOT_SSID}' password '{HOTSPOT_PASSWORD}'"
-        )
-    else:
-        # Open network - must create connection manually
-        # First, create an AP-mode connection without security
-        run_cmd(f"nmcli con add type wifi ifname {HOTSPOT_INTERFACE} con-name '{HOTSPOT_SSID}' ssid '{HOTSPOT_SSID}' mode ap")
-        run_cmd(f"nmcli con modify '{HOTSPOT_SSID}' wifi-sec.key-mgmt none")
-        run_cmd(f"nmcli con modify '{HOTSPOT_SSID}' ipv4.method shared")
-        run_cmd(f"nmcli con modify '{HOTSPOT_SSID}' ipv4.addresses 10.42.0.1/24")
-        output, code = run_cmd(f"nmcli con up '{HOTSPOT_SSID}'")
-    
-    if code == 0:
+    try:
+        nm.remove_hotspot()
+        time.sleep(1)
+        
+        # Create hotspot
+        success, output = nm.add_hotspot()
+    except Exception as e:
+        success, output = False, str(e)
+    
+    metrics.inc("wifi_autopilot_hotspot_transitions_total", state="up" if success else "failed")
+    if success:
         hotspot_active = True
         setup_iptables_redirect()
+        request_scan()  # have the list ready when a phone joins
         klipper_msg(f"WiFi Lost! Hotspot: {HOTSPOT_SSID}")
         log.info(f"Hotspot '{HOTSPOT_SSID}' is UP (open network)")
         return True
@@ -265,24 +773,69 @@ def disable_hotspot():
     log.info("=== DISABLING HOTSPOT ===")
     
     remove_iptables_redirect()
-    run_cmd(f"nmcli con down '{HOTSPOT_SSID}' 2>/dev/null")
-    run_cmd(f"nmcli con delete '{HOTSPOT_SSID}' 2>/dev/null")
-    
-    # Trigger rescan and auto-connect
-    run_cmd("nmcli dev wifi rescan")
-    run_cmd(f"nmcli dev set {HOTSPOT_INTERFACE} autoconnect yes")
+    try:
+        nm.remove_hotspot()
+        
+        # Trigger rescan and auto-connect
+        nm.rescan(wait=False)
+        nm.autoconnect()
+    except Exception as e:
+        log.error(f"Hotspot teardown failed: {e}")
     
     hotspot_active = False
+    metrics.inc("wifi_autopilot_hotspot_transitions_total", state="down")
     log.info("Hotspot disabled, attempting auto-connect")
 
 
 def scan_networks():
-    """Scan for available Wi-Fi networks."""
-    run_cmd("nmcli dev wifi rescan")
-    time.sleep(3)
-    output, _ = run_cmd("nmcli -t -f SSID dev wifi list")
-    ssids = list(set([x for x in output.split('\n') if x and x != HOTSPOT_SSID and x != '--']))
-    return sorted(ssids)
+    """Scan for available Wi-Fi networks, one entry per SSID with its strongest signal."""
+    nm.rescan()
+    networks = {}
+    for ssid, signal, security in nm.access_points():
+        if not ssid or ssid == HOTSPOT_SSID:
+            continue
+        if ssid not in networks or signal > networks[ssid]["signal"]:
+            networks[ssid] = {"ssid": ssid, "signal": signal, "security": security}
+    return sorted(networks.values(), key=lambda x: (-x["signal"], x["ssid"]))
+
+
+def request_scan():
+    """Ask the scanner for fresh results. A scan already running serves the request."""
+    global scan_requested
+    with scan_changed:
+        if not scan_running:
+            scan_requested = True
+            scan_changed.notify_all()
+
+
+def scanner_loop():
+    """Run requested scans and publish the results - runs in background thread."""
+    global scan_results, scan_time, scan_generation, scan_requested, scan_running
+    
+    while True:
+        with scan_changed:
+            scan_changed.wait_for(lambda: scan_requested)
+            scan_requested = False
+            scan_running = True
+        
+        try:
+            start = time.monotonic()
+            networks = scan_networks()
+            metrics.observe("wifi_autopilot_scan_seconds", time.monotonic() - start)
+            log.info(f"Scan found {len(networks)} networks in {time.monotonic() - start:.1f}s")
+        except Exception as e:
+            log.error(f"Scan error: {e}")
+            networks = None
+        
+        with scan_changed:
+            scan_running = False
+            if networks is not None:
+                scan_results = networks
+                scan_time = time.monotonic()
+                scan_generation += 1
+            scan_changed.notify_all()
+        for listener in scan_listeners:
+            listener()
 
 
 def connect_to_network(ssid, password=""):
@@ -294,14 +847,12 @@ def connect_to_network(ssid, password=""):
     time.sleep(2)
     
     # Connect
-    if password:
-        cmd = f"nmcli dev wifi connect '{ssid}' password '{password}'"
-    else:
-        cmd = f"nmcli dev wifi connect '{ssid}'"
-    
-    output, code = run_cmd(cmd, timeout=30)
+    try:
+        success, output = nm.connect(ssid, password)
+    except Exception as e:
+        success, output = False, str(e)
     
-    if code == 0 or "successfully" in output.lower():
+    if success:
         log.info(f"Connected to {ssid}")
         klipper_msg(f"Wi-Fi: {ssid}")
         return True, "Connected!"
@@ -312,62 +863,294 @@ def connect_to_network(ssid, password=""):
         return False, output or "Connection failed"
 
 
-# --- FLASK ROUTES ---
-@app.route('/')
-def index():
-    return render_template_string(HTML_TEMPLATE)
+# --- WEB PORTAL ROUTES ---
+CAPTIVE_REDIRECT = {"Location": "/", "Cache-Control": "no-store"}  # the same answer for every probe
+PAGE_CACHE_CONTROL = "no-cache"  # revalidate every time, the ETag makes that a bodiless 304
+index_page = None            # static_page() of HTML_TEMPLATE, built by make_portal()
+connect_job = {"id": 0, "ssid": None, "state": "idle", "message": ""}
+connect_task = None
+scan_done = None             # asyncio.Event set after a scan, then replaced
+job_changed = None           # asyncio.Event set when connect_job changes, then replaced
+
+
+def notify_scan_done():
+    global scan_done
+    event, scan_done = scan_done, asyncio.Event()
+    event.set()
+
+
+def notify_job_changed():
+    global job_changed
+    event, job_changed = job_changed, asyncio.Event()
+    event.set()
+
+
+async def stream_events(request, snapshot, changed):
+    """Answer with server-sent events: snapshot() now and whenever the changed() event fires.
+    
+    snapshot() returns (version, data), data goes out when the version moves on from the last one sent.
+    """
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+    await response.write(b"retry: 5000\n\n")
+    sent = None
+    while True:
+        event = changed()  # before the snapshot, a change in between wakes the wait
+        version, data = snapshot()
+        if version != sent:
+            await response.write(f"data: {json.dumps(data)}\n\n".encode())
+            sent = version
+        try:
+            await asyncio.wait_for(event.wait(), 15)
+        except asyncio.TimeoutError:
+            await response.write(b": keep-alive\n\n")
+
+
+def static_page(text, content_type):
+    """Encode a fixed page once: the body for every content coding the portal offers and its ETag."""
+    body = text.encode("utf8")
+    page = {
+        "content_type": content_type,
+        "etag": f'W/"{hashlib.sha256(body).hexdigest()[:16]}"',  # weak, the codings share it
+        "bodies": {"br": brotli.compress(body, quality=11)} if brotli else {},
+    }
+    page["bodies"].update(gzip=gzip.compress(body, 9, mtime=0), identity=body)
+    return page
 
 
-@app.route('/generate_204')
-@app.route('/gen_204')
-@app.route('/hotspot-detect')
-@app.route('/ncsi.txt')
-@app.route('/connecttest.txt')
-@app.route('/success.txt')
-@app.route('/canonical.html')
-def captive_redirect():
+def etag_matches(header, etag):
+    """If-None-Match: '*' or a list of entity tags, compared weakly (without the W/ prefix)."""
+    tag = etag[2:] if etag.startswith("W/") else etag
+    for entry in header.split(","):
+        entry = entry.strip()
+        if entry == "*" or (entry[2:] if entry.startswith("W/") else entry) == tag:
+            return True
+    return False
+
+
+def serve_page(request, page):
+    if etag_matches(request.headers.get("If-None-Match", ""), page["etag"]):
+        return web.Response(status=304, headers={"ETag": page["etag"], "Cache-Control": PAGE_CACHE_CONTROL})
+    
+    # the first coding the client accepts, in the order of preference above
+    accepted = {x.split(";")[0].strip() for x in request.headers.get("Accept-Encoding", "").split(",")
+                if not re.search(r";\s*q=0(\.0*)?\s*$", x)}
+    coding = next(x for x in page["bodies"] if x in accepted or x == "identity")
+    headers = {"ETag": page["etag"], "Cache-Control": PAGE_CACHE_CONTROL, "Vary": "Accept-Encoding"}
+    if coding != "identity":
+        headers["Content-Encoding"] = coding
+    return web.Response(body=page["bodies"][coding], headers=headers, content_type=page["content_type"],
+                        charset="utf-8")
+
+
+@routes.get('/')
+async def index(request):
+    return serve_page(request, index_page)
+
+
+@routes.get('/generate_204')
+@routes.get('/gen_204')
+@routes.get('/hotspot-detect')
+@routes.get('/ncsi.txt')
+@routes.get('/connecttest.txt')
+@routes.get('/success.txt')
+@routes.get('/canonical.html')
+async def captive_redirect(request):
     """Captive portal detection - redirect to main page."""
-    return redirect('/', code=302)
+    return web.Response(status=302, headers=CAPTIVE_REDIRECT)
+
+
+def scan_snapshot():
+    with scan_changed:
+        return scan_generation or None, {"networks": scan_results, "scanning": False}
+
 
+@routes.get('/scan')
+async def api_scan(request):
+    """Cached scan results, a new scan starts in the background when they are stale or ?refresh=1."""
+    with scan_changed:
+        if scan_time is None or time.monotonic() - scan_time > SCAN_TTL or request.query.get('refresh'):
+            request_scan()
+        return web.json_response({
+            "networks": scan_results,
+            "scanning": scan_running or scan_requested,
+            "age": None if scan_time is None else round(time.monotonic() - scan_time, 1)
+        })
 
-@app.route('/scan')
-def api_scan():
-    ssids = scan_networks()
-    return jsonify({"networks": ssids})
 
+@routes.get('/scan/events')
+async def api_scan_events(request):
+    """Server-sent events with the scan results, after every scan."""
+    return await stream_events(request, scan_snapshot, lambda: scan_done)
 
-@app.route('/connect', methods=['POST'])
-def api_connect():
-    data = request.json
+
+async def run_connect_job(ssid, password):
+    await asyncio.sleep(CONNECT_DELAY)  # let the answer reach the phone before the hotspot goes down
+    try:
+        success, message = await asyncio.get_running_loop().run_in_executor(None, connect_to_network, ssid, password)
+    except Exception as e:
+        success, message = False, str(e)
+    connect_job.update(state="connected" if success else "failed", message=message)
+    metrics.inc("wifi_autopilot_connect_total", result=connect_job["state"])
+    notify_job_changed()
+
+
+@routes.post('/connect')
+async def api_connect(request):
+    """Start connecting in the background, the job shows up in /connect/status and /connect/events."""
+    global connect_task
+    try:
+        data = await request.json()
+    except ValueError:
+        data = {}
+    if not isinstance(data, dict):
+        data = {}
     ssid = data.get('ssid', '')
     password = data.get('password', '')
     
     if not ssid:
-        return jsonify({"success": False, "message": "No network selected"})
+        return web.json_response({**connect_job, "state": "failed", "message": "No network selected"}, status=400)
+    if connect_job["state"] == "connecting":
+        return web.json_response({**connect_job, "message": f"Already connecting to {connect_job['ssid']}"},
+                                 status=409)
     
-    success, message = connect_to_network(ssid, password)
-    return jsonify({"success": success, "message": message})
+    connect_job.update(id=connect_job["id"] + 1, ssid=ssid, state="connecting", message="Connecting")
+    connect_task = asyncio.create_task(run_connect_job(ssid, password))
+    notify_job_changed()
+    return web.json_response(connect_job, status=202)
+
+
+@routes.get('/connect/status')
+async def api_connect_status(request):
+    return web.json_response(connect_job)
+
+
+@routes.get('/connect/events')
+async def api_connect_events(request):
+    """Server-sent events with the connect job, now and on every change."""
+    return await stream_events(request, lambda: ((connect_job["id"], connect_job["state"]), connect_job),
+                               lambda: job_changed)
+
+
+@routes.get('/metrics')
+async def api_metrics(request):
+    return web.Response(body=metrics.render().encode(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
 
 
-@app.route('/status')
-def api_status():
-    return jsonify({
-        "connected": is_connected(),
-        "ssid": get_current_ssid(),
+@routes.get('/health')
+async def api_health(request):
+    """200 while the monitor loop keeps checking, 503 when it stopped."""
+    age = time.monotonic() - (last_check or started)
+    healthy = age < HEALTH_MAX_AGE + (0 if last_check else BOOT_DELAY)
+    return web.json_response({
+        "status": "ok" if healthy else "stalled",
+        "last_check_age": round(age, 1),
+        "offline": offline_count > 0,
+        "hotspot_active": hotspot_active,
+        "network_manager": nm.name
+    }, status=200 if healthy else 503)
+
+
+@routes.get('/status')
+async def api_status(request):
+    loop = asyncio.get_running_loop()
+    connected, ssid = await asyncio.gather(loop.run_in_executor(None, is_connected),
+                                           loop.run_in_executor(None, get_current_ssid))
+    return web.json_response({
+        "connected": connected,
+        "ssid": ssid,
         "hotspot_active": hotspot_active
     })
 
 
+async def portal_startup(app):
+    global scan_done, job_changed
+    loop = asyncio.get_running_loop()
+    scan_done, job_changed = asyncio.Event(), asyncio.Event()
+    scan_listeners.append(lambda: loop.call_soon_threadsafe(notify_scan_done))
+
+
+def make_portal():
+    global index_page
+    index_page = static_page(HTML_TEMPLATE, "text/html")
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(portal_startup)
+    return app
+
+
+# --- NETWORK EVENTS ---
+def netlink_watch():
+    """Report link, address and route changes from the kernel - runs in background thread."""
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+    except (AttributeError, OSError) as e:
+        log.warning(f"netlink not available, relying on NetworkManager and polling: {e}")
+        return
+    
+    link_state = {}
+    while True:
+        data = sock.recv(65536)
+        offset = 0
+        while offset + 16 <= len(data):
+            # nlmsghdr: length, type, flags, seq, pid
+            length, msg_type = struct.unpack_from("=IH", data, offset)
+            if length < 16:
+                break
+            if msg_type == 16 and length >= 32:
+                # ifinfomsg: family, type, index, flags, change. Wireless events (scans, signal)
+                # arrive as new link messages too, only a change of carrier is worth a check.
+                _, _, index, flags, _ = struct.unpack_from("=HHiII", data, offset + 16)
+                state = flags & IFF_LINK_STATE
+                if link_state.get(index) != state and not flags & IFF_LOOPBACK:
+                    events.put(("netlink", f"link {index} {'up' if state == IFF_LINK_STATE else 'down'}"))
+                link_state[index] = state
+            elif msg_type in RTM_NAMES and msg_type != 16:
+                events.put(("netlink", RTM_NAMES[msg_type]))
+            offset += (length + 3) & ~3
+
+
+def nm_watch():
+    """Report NetworkManager state and connectivity changes - runs in background thread.
+    
+    Over D-Bus from its signals, with the nmcli fallback from nmcli monitor.
+    """
+    nm.watch(lambda detail: events.put(("nm", detail)))
+
+
+def wait_for_change(timeout):
+    """Wait up to timeout seconds for a network event, then let the burst that follows it settle."""
+    try:
+        event = events.get(timeout=timeout)
+    except queue.Empty:
+        return None
+    metrics.inc("wifi_autopilot_network_events_total", source=event[0])
+    deadline = time.monotonic() + EVENT_SETTLE
+    while (remaining := deadline - time.monotonic()) > 0:
+        try:
+            source, _ = events.get(timeout=remaining)
+        except queue.Empty:
+            break
+        metrics.inc("wifi_autopilot_network_events_total", source=source)
+    return event
+
+
 # --- MONITOR LOOP ---
 def monitor_loop():
     """Main monitoring loop - runs in background thread."""
-    global offline_count, online_count, hotspot_active
+    global offline_count, online_count, hotspot_active, outage_start, offline_seconds, last_check
     
     log.info("Monitor starting, waiting for system boot...")
-    time.sleep(20)  # Wait for system to fully boot
+    time.sleep(BOOT_DELAY)  # Wait for system to fully boot
     
     # Check if we should clean up any existing hotspot
-    current, _ = run_cmd("iwgetid -r")
+    try:
+        current = nm.current_ssid()
+    except Exception as e:
+        log.error(f"SSID query failed: {e}")
+        current = None
     if current == HOTSPOT_SSID:
         log.info("Cleaning up existing hotspot from previous run")
         disable_hotspot()
@@ -377,10 +1160,18 @@ def monitor_loop():
     
     while True:
         try:
+            start = time.monotonic()
             connected = is_connected()
+            last_check = time.monotonic()
+            metrics.observe("wifi_autopilot_check_seconds", last_check - start,
+                            result="online" if connected else "offline")
             current_ssid = get_current_ssid()
             
             if connected:
+                if outage_start is not None:
+                    metrics.observe("wifi_autopilot_outage_seconds", start - outage_start)
+                    offline_seconds += start - outage_start
+                    outage_start = None
                 online_count += 1
                 offline_count = 0
                 
@@ -393,6 +1184,8 @@ def monitor_loop():
                     log.info(f"Online: {current_ssid}")
             
             else:
+                if outage_start is None:
+                    outage_start = start
                 offline_count += 1
                 online_count = 0
                 
@@ -406,21 +1199,74 @@ def monitor_loop():
         except Exception as e:
             log.error(f"Monitor error: {e}")
         
-        time.sleep(CHECK_INTERVAL)
+        # Check again soon while counting towards a hotspot change, otherwise sleep until
+        # something changes. The slow poll catches an uplink that dies without a local event.
+        confirming = offline_count > 0 if not hotspot_active else online_count > 0
+        event = wait_for_change(CONFIRM_INTERVAL if confirming else CHECK_INTERVAL)
+        if event:
+            log.debug(f"Network event from {event[0]}: {event[1]}")
+
+
+def state_gauges():
+    """Gauges for /metrics, read at scrape time."""
+    now = time.monotonic()
+    cpu = os.times()
+    with open("/proc/self/statm") as f:
+        resident = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    return [
+        ("wifi_autopilot_offline", {}, int(offline_count > 0)),
+        ("wifi_autopilot_hotspot_active", {}, int(hotspot_active)),
+        ("wifi_autopilot_offline_seconds_total", {}, offline_seconds + (now - outage_start if outage_start else 0)),
+        ("wifi_autopilot_queue_depth", {"queue": "events"}, events.qsize()),
+        ("wifi_autopilot_queue_depth", {"queue": "lcd"}, notify_queue.qsize()),
+        ("wifi_autopilot_queue_depth", {"queue": "scan_requests"}, int(scan_requested)),
+        ("wifi_autopilot_last_check_age_seconds", {}, now - (last_check or started)),
+        ("process_cpu_seconds_total", {}, cpu.user + cpu.system + cpu.children_user + cpu.children_system),
+        ("process_resident_memory_bytes", {}, resident),
+    ]
+
+
+metrics.gauges.append(state_gauges)
 
 
 # --- MAIN ---
-if __name__ == '__main__':
+def main():
+    global nm
+    
+    parser = argparse.ArgumentParser(description="Klipper Wi-Fi Autopilot")
+    parser.add_argument("--nmcli", action="store_true", help="use nmcli even when D-Bus is available")
+    args = parser.parse_args()
+    
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(LOG_FILE)
+        ]
+    )
+    
     log.info("=" * 50)
-    log.info("  Klipper Wi-Fi Autopilot v3.0")
+    log.info("  Klipper Wi-Fi Autopilot v3.3")
     log.info("=" * 50)
-    log.info(f"Flask will run on port {FLASK_PORT}")
+    log.info(f"Portal will run on port {PORTAL_PORT}")
     log.info(f"Hotspot SSID: {HOTSPOT_SSID}")
     log.info(f"Hotspot Password: {'(Open Network)' if not HOTSPOT_PASSWORD else HOTSPOT_PASSWORD}")
     
-    # Start monitor thread
+    nm = ShellNetworkManager() if args.nmcli else open_network_manager()
+    log.info(f"NetworkManager via {nm.name}")
+    
+    # Start event sources and monitor thread
+    threading.Thread(target=netlink_watch, daemon=True).start()
+    threading.Thread(target=nm_watch, daemon=True).start()
+    threading.Thread(target=scanner_loop, daemon=True).start()
+    threading.Thread(target=notifier_loop, daemon=True).start()
     monitor = threading.Thread(target=monitor_loop, daemon=True)
     monitor.start()
     
-    # Run Flask
-    app.run(host='0.0.0.0', port=FLASK_PORT, threaded=True)
+    # Run the portal, without an access log: phones probe the captive URLs every few seconds
+    web.run_app(make_portal(), host='0.0.0.0', port=PORTAL_PORT, access_log=None, print=None)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+"""
+Klipper Wi-Fi Autopilot - simulation, tests and benchmarks
+
+Runs parts of wifi_autopilot.py with fakes in place of the system, from the same directory:
+- --simulate runs the monitor against fake outages and reports detection latency
+- --test-dbus runs the D-Bus client against a fake NetworkManager, use with dbus-run-session
+- --bench-probes times the connectivity checks against the configured targets
+"""
+
+import time
+import subprocess
+import logging
+import threading
+import os
+import argparse
+import statistics
+
+import wifi_autopilot as autopilot
+from wifi_autopilot import (DBUS_PROPERTIES, HOTSPOT_SSID, NM_ACCESS_POINT, NM_ACTIVATED, NM_ACTIVE, NM_BUS,
+                            NM_DEACTIVATED, NM_DEVICE, NM_FAILURE_REASONS, NM_PATH, NM_SETTINGS, NM_SETTINGS_PATH,
+                            NM_WIRELESS, PROBE_BUDGET, PROBE_TARGETS, DBusNetworkManager)
+
+try:
+    from jeepney import DBusAddress, MessageType, new_method_return, new_error, new_signal
+    from jeepney.bus_messages import message_bus
+    from jeepney.io.blocking import open_dbus_connection
+except ImportError:
+    open_dbus_connection = None
+
+
+# --- SIMULATION ---
+def simulate(rounds, use_events=True):
+    """Run the monitor against fake outages and report how long it takes to react.
+    
+    Probes, hotspot changes and LCD messages are replaced, nothing on the system is touched.
+    """
+    online = threading.Event()
+    online.set()
+    changed = threading.Condition()
+    
+    def fake_enable_hotspot():
+        with changed:
+            autopilot.hotspot_active = True
+            changed.notify_all()
+        return True
+    
+    def fake_disable_hotspot():
+        with changed:
+            autopilot.hotspot_active = False
+            changed.notify_all()
+    
+    autopilot.BOOT_DELAY = 0
+    autopilot.is_connected = online.is_set
+    autopilot.get_current_ssid = lambda: "Simulated"
+    autopilot.run_cmd = lambda cmd, timeout=15: ("", 0)
+    autopilot.enable_hotspot = fake_enable_hotspot
+    autopilot.disable_hotspot = fake_disable_hotspot
+    autopilot.klipper_msg = lambda msg: None
+    
+    threading.Thread(target=autopilot.monitor_loop, daemon=True).start()
+    while autopilot.online_count == 0:
+        time.sleep(0.01)
+    
+    def react(connected, hotspot):
+        if connected:
+            online.set()
+        else:
+            online.clear()
+        start = time.monotonic()
+        if use_events:
+            autopilot.events.put(("simulate", "link up" if connected else "link down"))
+        with changed:
+            changed.wait_for(lambda: autopilot.hotspot_active == hotspot)
+        return time.monotonic() - start
+    
+    outage, recovery = [], []
+    for i in range(rounds):
+        outage.append(react(False, True))
+        recovery.append(react(True, False))
+        print(f"round {i + 1}: hotspot up after {outage[-1]:.2f}s, down after {recovery[-1]:.2f}s")
+    for name, times in (("outage", outage), ("recovery", recovery)):
+        print(f"{name} detection: min {min(times):.2f}s, median {statistics.median(times):.2f}s, max {max(times):.2f}s")
+
+
+# --- D-BUS TEST ---
+class FakeNetworkManager:
+    """NetworkManager stand-in for --test-dbus: one wireless device, three access points and the
+    methods and properties the D-Bus client uses, and the signals it watches. Connections come up after
+    a short delay."""
+    
+    def __init__(self, bus="SESSION"):
+        self.conn = open_dbus_connection(bus)
+        self.send_lock = threading.Lock()  # replies and signals from timer threads share the connection
+        self.conn.send_and_get_reply(message_bus.RequestName(NM_BUS))
+        self.device = f"{NM_PATH}/Devices/1"
+        self.objects = {self.device: {
+            NM_DEVICE: {"Autoconnect": ("b", False), "StateReason": ("(uu)", (100, 0))},
+            NM_WIRELESS: {"ActiveAccessPoint": ("o", "/"), "LastScan": ("x", -1)}}}
+        self.passwords = {}
+        self.connections = {}  # path: settings
+        self.serial = 0
+        for ssid, strength, password in (("Workshop", 70, "printer123"), ("Workshop", 40, "printer123"),
+                                         ("Cafe", 55, "")):
+            ap = self.add_object("AccessPoint", {NM_ACCESS_POINT: {
+                "Ssid": ("ay", ssid.encode()), "Strength": ("y", strength), "Flags": ("u", 1 if password else 0),
+                "WpaFlags": ("u", 0), "RsnFlags": ("u", 0x188 if password else 0)}})
+            self.passwords[ap] = password
+    
+    def add_object(self, kind, props):
+        self.serial += 1
+        path = f"{NM_PATH}/{kind}/{self.serial}"
+        self.objects[path] = props
+        return path
+    
+    def set(self, path, interface, name, value):
+        signature, _ = self.objects[path][interface][name]
+        self.objects[path][interface][name] = (signature, value)
+        self.signal(path, DBUS_PROPERTIES, "PropertiesChanged", "sa{sv}as", interface, {name: (signature, value)}, [])
+    
+    def signal(self, path, interface, member, signature, *args):
+        self.send(new_signal(DBusAddress(path, interface=interface), member, signature, args))
+    
+    def send(self, msg):
+        with self.send_lock:
+            self.conn.send(msg)
+    
+    def later(self, delay, function, *args):
+        threading.Timer(delay, function, args).start()
+    
+    def serve(self):
+        while True:
+            msg = self.conn.receive()
+            if msg.header.message_type != MessageType.method_call:
+                continue
+            try:
+                reply = self.handle(msg)
+            except KeyError as e:
+                reply = new_error(msg, "org.freedesktop.DBus.Error.UnknownObject", "s", (f"No such object {e}",))
+            except ValueError as e:
+                reply = new_error(msg, "org.freedesktop.NetworkManager.Settings.InvalidProperty", "s", (str(e),))
+            self.send(reply)
+    
+    def handle(self, msg):
+        fields = msg.header.fields
+        path, interface, method = fields[1], fields[2], fields[3]
+        if interface == DBUS_PROPERTIES:
+            props = self.objects[path][msg.body[0]]
+            if method == "Get":
+                return new_method_return(msg, "v", (props[msg.body[1]],))
+            if method == "GetAll":
+                return new_method_return(msg, "a{sv}", (props,))
+            self.set(path, msg.body[0], msg.body[1], msg.body[2][1])
+        elif method == "GetDeviceByIpIface":
+            return new_method_return(msg, "o", (self.device,))
+        elif method == "GetAllAccessPoints":
+            return new_method_return(msg, "ao", ([p for p in self.objects if "/AccessPoint/" in p],))
+        elif method == "RequestScan":
+            self.later(0.3, self.set, self.device, NM_WIRELESS, "LastScan", int(time.monotonic() * 1000))
+        elif method == "ListConnections":
+            return new_method_return(msg, "ao", (list(self.connections),))
+        elif method == "GetSettings":
+            return new_method_return(msg, "a{sa{sv}}", (self.connections[path],))
+        elif method == "Delete":
+            del self.connections[path]
+            self.objects.pop(path)
+            self.set(self.device, NM_WIRELESS, "ActiveAccessPoint", "/")
+        elif method == "AddAndActivateConnection":
+            return new_method_return(msg, "oo", self.add_and_activate(*msg.body))
+        else:
+            raise KeyError(f"{interface}.{method}")
+        return new_method_return(msg)
+    
+    def add_and_activate(self, settings, device, ap):
+        wireless = settings["802-11-wireless"]
+        ssid = bytes(wireless["ssid"][1])
+        psk = settings.get("802-11-wireless-security", {}).get("psk", ("s", ""))[1]
+        if psk and not 8 <= len(psk) <= 63:
+            raise ValueError("802-11-wireless-security.psk: property is invalid")
+        settings.setdefault("connection", {}).setdefault("id", ("s", ssid.decode()))
+        connection = self.add_object("Settings", {})
+        self.connections[connection] = settings
+        active = self.add_object("ActiveConnection", {NM_ACTIVE: {"State": ("u", 1)}})
+        
+        if wireless.get("mode", ("s", ""))[1] == "ap":
+            ap = self.add_object("AccessPoint", {NM_ACCESS_POINT: {
+                "Ssid": ("ay", ssid), "Strength": ("y", 100), "Flags": ("u", 0), "WpaFlags": ("u", 0),
+                "RsnFlags": ("u", 0)}})
+            success, reason = True, 0
+        elif ap not in self.passwords:
+            success, reason = False, 53
+        else:
+            success, reason = psk == self.passwords[ap], 8
+        
+        def done():
+            self.set(active, NM_ACTIVE, "State", NM_ACTIVATED if success else NM_DEACTIVATED)
+            self.set(self.device, NM_DEVICE, "StateReason", (100 if success else 120, reason))
+            if success:
+                self.set(self.device, NM_WIRELESS, "ActiveAccessPoint", ap)
+            self.signal(self.device, NM_DEVICE, "StateChanged", "uuu", 100 if success else 120, 70, reason)
+        self.later(0.2, done)
+        return connection, active
+
+
+def test_dbus():
+    """Exercise the D-Bus client against FakeNetworkManager on the session bus.
+    
+    Run under a private bus: dbus-run-session -- python3 wifi_autopilot_bench.py --test-dbus
+    """
+    threading.Thread(target=FakeNetworkManager().serve, daemon=True).start()
+    nm = autopilot.nm = DBusNetworkManager("SESSION")
+    autopilot.SCAN_SETTLE = 1
+    signals = []
+    threading.Thread(target=nm.watch, args=(signals.append,), daemon=True).start()
+    time.sleep(0.5)  # subscribed by then
+    
+    def check(name, result, expected):
+        print(f"{'ok  ' if result == expected else 'FAIL'} {name}: {result!r}")
+        return result == expected
+    
+    results = [
+        check("ssid before connecting", autopilot.get_current_ssid(), None),
+        check("scan", [(n["ssid"], n["signal"], n["security"]) for n in autopilot.scan_networks()],
+              [("Workshop", 70, "WPA2"), ("Cafe", 55, "")]),
+        check("wrong password", nm.connect("Workshop", "wrongpass"), (False, NM_FAILURE_REASONS[8])),
+        check("short password", nm.connect("Workshop", "short")[0], False),
+        check("unknown network", nm.connect("Elsewhere", ""), (False, NM_FAILURE_REASONS[53])),
+        check("connect", nm.connect("Workshop", "printer123"), (True, "Connected")),
+        check("ssid", autopilot.get_current_ssid(), "Workshop"),
+        check("hotspot up", nm.add_hotspot(), (True, "Connected")),
+        check("hotspot ssid", nm.current_ssid(), HOTSPOT_SSID),
+        check("hotspot down", (nm.remove_hotspot(), nm.autoconnect(), nm.current_ssid()), (None, None, None)),
+        check("autoconnect", nm.get(nm.device, NM_DEVICE, "Autoconnect"), True),
+        check("failed connections removed", len(nm.call(NM_SETTINGS_PATH, NM_SETTINGS, "ListConnections")[0]), 1),
+    ]
+    time.sleep(0.3)
+    # connecting changes the access point and the device state, scans only their stamp
+    results.append(check("signals", (any("ActiveAccessPoint" in s for s in signals),
+                                     any(s.endswith("state 100") for s in signals),
+                                     any("LastScan" in s for s in signals)), (True, True, False)))
+    
+    count = 200
+    start = time.monotonic()
+    for _ in range(count):
+        nm.current_ssid()
+    dbus_time = (time.monotonic() - start) / count
+    start = time.monotonic()
+    for _ in range(count):
+        autopilot.run_cmd("true")
+    shell_time = (time.monotonic() - start) / count
+    print(f"SSID query {dbus_time * 1000:.2f}ms over D-Bus, one shell process costs {shell_time * 1000:.2f}ms")
+    print(f"{sum(results)}/{len(results)} passed")
+    return all(results)
+
+
+# --- BENCHMARK ---
+def bench_probes(count):
+    """Time connectivity checks against the configured targets, with ping for comparison if it is installed."""
+    def measure(name, check):
+        latency, results = [], []
+        cpu = os.times()
+        for _ in range(count):
+            start = time.monotonic()
+            results.append(check())
+            latency.append(time.monotonic() - start)
+        cpu = [b - a for a, b in zip(cpu, os.times())]
+        # user + system of this process and its children
+        print(f"{name:<8} online {sum(results)}/{count}, latency median {statistics.median(latency) * 1000:.1f}ms"
+              f" max {max(latency) * 1000:.1f}ms, cpu {sum(cpu[:4]) / count * 1000:.2f}ms a check")
+    
+    def ping():
+        for host, _ in PROBE_TARGETS:
+            result = subprocess.run(["ping", "-c", "1", "-W", "2", host],
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=5)
+            if result.returncode == 0:
+                return True
+        return False
+    
+    targets = ", ".join(f"{host}:{port}" for host, port in PROBE_TARGETS)
+    print(f"{count} checks, targets {targets}, budget {PROBE_BUDGET}s")
+    measure("connect", autopilot.is_connected)
+    if subprocess.run("command -v ping", shell=True, stdout=subprocess.DEVNULL).returncode == 0:
+        measure("ping", ping)
+
+
+# --- MAIN ---
+def main():
+    parser = argparse.ArgumentParser(description="Klipper Wi-Fi Autopilot simulation, tests and benchmarks")
+    parser.add_argument("--simulate", type=int, metavar="ROUNDS",
+                        help="run the monitor against fake outages and report detection latency")
+    parser.add_argument("--no-events", action="store_true", help="simulate without network events, polling only")
+    parser.add_argument("--bench-probes", type=int, metavar="COUNT", help="time COUNT connectivity checks")
+    parser.add_argument("--test-dbus", action="store_true",
+                        help="run the D-Bus client against a fake NetworkManager, use with dbus-run-session")
+    args = parser.parse_args()
+    
+    logging.basicConfig(level=logging.INFO, format=autopilot.LOG_FORMAT)
+    
+    if args.test_dbus:
+        if open_dbus_connection is None:
+            print("--test-dbus needs python3-jeepney")
+            raise SystemExit(1)
+        raise SystemExit(0 if test_dbus() else 1)
+    if args.bench_probes:
+        bench_probes(args.bench_probes)
+    elif args.simulate:
+        simulate(args.simulate, not args.no_events)
+    else:
+        parser.print_help()
+
+
+if __name__ == '__main__':
+    main()
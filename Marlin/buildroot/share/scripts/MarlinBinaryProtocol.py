@@ -2,7 +2,7 @@
 # MarlinBinaryProtocol.py
 # Supporting Firmware upload via USB/Serial, saving to the attached media.
 #
-import serial, math, time, threading, sys, datetime, random
+import serial, time, threading, queue, sys, os, mmap, datetime, random, itertools, struct, hashlib
 from collections import deque
 
 try:
@@ -15,9 +15,34 @@ except ImportError:
     except ImportError:
         heatshrink_exists = False
 
+# heatshrink builds with the incremental encoder can compress while the transfer runs
+heatshrink_streaming = heatshrink_exists and hasattr(heatshrink, 'core') and hasattr(heatshrink.core, 'Encoder')
+
+try:
+    import numpy
+    numpy_exists = True
+except ImportError:
+    numpy_exists = False
+
 def millis():
     return time.perf_counter() * 1000
 
+def parse_listing(lines):
+    files = {}
+    for line in lines:
+        columns = line.split(' ', 2)
+        if len(columns) >= 2 and columns[1].isdigit():
+            for name in columns[:1] + columns[2:]:
+                files[name] = int(columns[1])
+    return files
+
+def file_digest(filename):
+    sha = hashlib.sha256()
+    with open(filename, "rb") as source:
+        for chunk in iter(lambda: source.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
 class TimeOut(object):
     def __init__(self, milliseconds):
         self.duration = milliseconds
@@ -52,7 +77,7 @@ class Protocol(object):
     packet_ping = None
 
     errors = 0
-    packet_buffer = None
+    packet_buffers = None
     simulate_errors = 0
     sync = 0
     connected = False
@@ -61,35 +86,56 @@ class Protocol(object):
 
     response_timeout = 1000
 
-    applications = []
-    responses = deque()
-
-    def __init__(self, device, baud, bsize, simerr, timeout):
-        print("pySerial Version:", serial.VERSION)
-        self.port = serial.Serial(device, baudrate = baud, write_timeout = 0, timeout = 1)
+    # sliding window, packets sent but not yet acknowledged
+    window_size = 1
+    max_window_size = 64
+    inflight = None
+    window_timeout = None
+    resend_sync = None
+    resend_fence = False        # the sync control packet sent ahead of a resend is not answered yet
+    resending = False           # a resend is on its way and none of its packets was acknowledged yet
+    srtt = None                 # smoothed round trip of a windowed packet, seconds
+
+    applications = None
+    applications_lock = None
+    dispatch_table = None
+    responses = None
+    metrics = None
+    send_times = None
+
+    def __init__(self, device, baud, bsize, simerr, timeout, window = 1):
         self.device = device
         self.baud = baud
         self.block_size = int(bsize)
         self.simulate_errors = max(min(simerr, 1.0), 0.0)
-        self.connected = True
         self.response_timeout = timeout
+        self.window_size = max(min(int(window), self.max_window_size), 1)
+        self.inflight = deque()
+        self.packet_buffers = [bytearray() for _ in range(1 << self.window_size.bit_length())]
+        self.window_timeout = TimeOut(self.response_timeout * 20)
+        self.applications = []
+        self.applications_lock = threading.Lock()
+        self.incoming = b''
+        self.metrics = TransferMetrics()
+        self.send_times = [None] * 256  # when each sync id was sent, None once it was retransmitted
 
         self.register(['ok', 'rs', 'ss', 'fe'], self.process_input)
+        self.start()
 
-        self.worker_thread = threading.Thread(target=Protocol.receive_worker, args=(self,))
-        self.worker_thread.start()
+    def start(self):
+        # Open the port and hand what it receives to the responses queue from a worker thread
+        print("pySerial Version:", serial.VERSION)
+        self.port = serial.Serial(self.device, baudrate = self.baud, write_timeout = 0, timeout = 1)
+        self.responses = queue.Queue()
+        self.connected = True
 
-    def receive_worker(self):
+        # Drop stale input before anything is sent, once the worker runs the answers count
         while self.port.in_waiting:
             self.port.reset_input_buffer()
+        self.worker_thread = threading.Thread(target=Protocol.receive_worker, args=(self,))
+        self.worker_thread.start()
 
-        def dispatch(data):
-            for tokens, callback in self.applications:
-                for token in tokens:
-                    if token == data[:len(token)]:
-                        callback((token, data[len(token):]))
-                        return
-
+    def receive_worker(self):
         def reconnect():
             print("Reconnecting..")
             self.port.close()
@@ -107,15 +153,31 @@ class Protocol(object):
 
         while self.connected:
             try:
-                data = self.port.readline().decode('utf8').rstrip()
-                if len(data):
-                    #print(data)
-                    dispatch(data)
+                # readline() costs a system call per byte, take whatever has arrived and split it here
+                self.receive(self.port.read(self.port.in_waiting or 1))
             except OSError:
                 reconnect()
-            except UnicodeDecodeError:
-                # dodgy client output or datastream corruption
-                self.port.reset_input_buffer()
+
+    def receive(self, data):
+        *lines, self.incoming = (self.incoming + data).split(b'\n')
+        for line in lines:
+            self.dispatch(line)
+
+    def dispatch(self, line):
+        # Lines stay bytes until a handler takes them, temperature reports and other chatter nobody
+        # registered for are dropped after one dict lookup on their first byte
+        line = line.rstrip()
+        #print(line)
+        if not line:
+            return
+        for token, text, callback in self.dispatch_table.get(line[:1]) or self.dispatch_table[b'']:
+            if line.startswith(token):
+                try:
+                    data = line[len(token):].decode('utf8')
+                except UnicodeDecodeError:
+                    return # dodgy client output or datastream corruption
+                callback((text, data))
+                return
 
     def shutdown(self):
         self.connected = False
@@ -124,17 +186,44 @@ class Protocol(object):
 
     def process_input(self, data):
         #print(data)
-        self.responses.append(data)
+        self.responses.put(data)
 
     def register(self, tokens, callback):
-        self.applications.append((tokens, callback))
+        # The table is replaced, never changed in place, so receive_worker can dispatch on it without locking.
+        # Registering the same tokens again hands them to the new callback, a reconnect doesn't pile up handlers.
+        with self.applications_lock:
+            self.set_applications([(t, c) for t, c in self.applications if t != tokens] + [(tokens, callback)])
+
+    def unregister(self, callback):
+        with self.applications_lock:
+            self.set_applications([(t, c) for t, c in self.applications if c != callback])
+
+    def set_applications(self, applications):
+        # Compiled to first byte -> [(token, text, callback)] in registration order, so a line is matched
+        # against the few tokens sharing its first byte and the earliest registered token still wins.
+        # An empty token takes every line, it is in each entry and alone under b'' for the other lines.
+        entries = [(text.encode('utf8'), text, callback) for tokens, callback in applications for text in tokens]
+        table = {b'': [entry for entry in entries if not entry[0]]}
+        for token, _, _ in entries:
+            if token and token[:1] not in table:
+                table[token[:1]] = [entry for entry in entries if entry[0][:1] in (token[:1], b'')]
+        self.applications = applications
+        self.dispatch_table = table
+
+    def windowed(self):
+        return self.window_size > 1 and self.syncronised
 
     def send(self, protocol, packet_type, data = bytearray()):
+        if self.windowed():
+            self.send_windowed(protocol, packet_type, data)
+            return
+
         self.packet_transit = self.build_packet(protocol, packet_type, data)
         self.packet_status = 0
         self.transmit_attempt = 0
 
         timeout = TimeOut(self.response_timeout * 20)
+        send_time = time.perf_counter()
         while self.packet_status == 0:
             try:
                 if timeout.timedout():
@@ -143,20 +232,90 @@ class Protocol(object):
                 self.await_response()
             except ReadTimeout:
                 self.errors += 1
+                self.metrics.timeouts += 1
                 #print("Packetloss detected..")
+        if self.transmit_attempt == 1:
+            self.metrics.add_rtt(time.perf_counter() - send_time)
         self.packet_transit = None
 
-    def await_response(self):
-        timeout = TimeOut(self.response_timeout)
-        while not len(self.responses):
-            time.sleep(0.00001)
-            if timeout.timedout():
-                raise ReadTimeout()
-
-        while len(self.responses):
-            token, data = self.responses.popleft()
-            switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error}
+    def await_response(self, timeout = None):
+        # Block until receive_worker hands over a response, then handle any others already queued
+        try:
+            response = self.responses.get(timeout = (timeout or self.response_timeout) / 1000)
+        except queue.Empty:
+            raise ReadTimeout()
+
+        while response:
+            token, data = response
+            if self.windowed():
+                switch = {'ok' : self.window_ok, 'rs': self.window_resend, 'ss' : self.window_stream_sync, 'fe' : self.response_fatal_error}
+            else:
+                switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error}
             switch[token](data)
+            try:
+                response = self.responses.get_nowait()
+            except queue.Empty:
+                response = None
+
+    def send_windowed(self, protocol, packet_type, data = bytearray()):
+        # Keep up to window_size packets with consecutive sync ids in flight,
+        # the client processes them in order and acknowledges each one
+        while len(self.inflight) >= self.window_size:
+            self.await_window()
+
+        if not len(self.inflight):
+            self.window_timeout.reset()
+        packet = self.build_packet(protocol, packet_type, data)
+        self.inflight.append((self.sync, packet))
+        self.send_times[self.sync] = time.perf_counter()
+        self.sync = (self.sync + 1) % 256
+        self.transmit_attempt = 0
+        self.transmit_packet(packet)
+
+    def window_response_timeout(self):
+        # Resent packets are answered within a round trip or two. A client that doesn't answer by then
+        # lost the start token of the fence or of the first resent packet and drops the rest silently.
+        if not self.resending or self.srtt is None:
+            return self.response_timeout
+        return min(max(self.srtt * 4000, 10), self.response_timeout)
+
+    def await_window(self):
+        if self.window_timeout.timedout():
+            raise ConnectionLost()
+        try:
+            self.await_response(self.window_response_timeout())
+        except ReadTimeout:
+            self.errors += 1
+            self.metrics.timeouts += 1
+            #print("Packetloss detected, requesting stream sync..")
+            # The sync control packet is answered regardless of the stream sync,
+            # the 'ss' response tells which packets actually arrived
+            self.resend_fence = self.resending = False
+            self.transmit_packet(self.build_packet(0, 1))
+
+    def flush(self):
+        # Wait until every packet in flight has been acknowledged
+        while len(self.inflight):
+            self.await_window()
+
+    def retransmit_window(self, packet_id):
+        # The client expects packet_id next, everything sent before it was received
+        if packet_id != self.sync and not any(sync == packet_id for sync, _ in self.inflight):
+            raise SycronisationError()
+        while len(self.inflight) and self.inflight[0][0] != packet_id:
+            self.inflight.popleft()
+        self.window_timeout.reset()
+
+        # Packets following a bad one are dropped by the client, go back and resend them all.
+        # Their acknowledgements no longer tell a round trip time. A sync control packet goes first
+        # as a fence: the client answers in order, so resend requests before its 'ss' were caused by
+        # packets sent before the resend, the ones after it by the resent packets themselves.
+        self.transmit_packet(self.build_packet(0, 1))
+        for sync, packet in self.inflight:
+            self.send_times[sync] = None
+            self.transmit_packet(packet)
+        self.resend_sync = packet_id
+        self.resend_fence = self.resending = True
 
     def send_ascii(self, data, send_and_forget = False):
         self.packet_transit = bytearray(data, "utf8") + b'\n'
@@ -175,18 +334,17 @@ class Protocol(object):
                     self.await_response_ascii()
             except ReadTimeout:
                 self.errors += 1
+                self.metrics.timeouts += 1
                 #print("Packetloss detected..")
             except serial.SerialException:
                 return
         self.packet_transit = None
 
     def await_response_ascii(self):
-        timeout = TimeOut(self.response_timeout)
-        while not len(self.responses):
-            time.sleep(0.00001)
-            if timeout.timedout():
-                raise ReadTimeout()
-        token, data = self.responses.popleft()
+        try:
+            token, data = self.responses.get(timeout = self.response_timeout / 1000)
+        except queue.Empty:
+            raise ReadTimeout()
         self.packet_status = 1
 
     def corrupt_array(self, data):
@@ -195,8 +353,8 @@ class Protocol(object):
         return data
 
     def transmit_packet(self, packet):
-        packet = bytearray(packet)
         if (self.simulate_errors > 0 and random.random() > (1.0 - self.simulate_errors)):
+            packet = bytearray(packet) # damage a copy, the packet itself may still be resent
             if random.random() > 0.9:
                 #random data drop
                 start = random.randint(0, len(packet))
@@ -207,39 +365,61 @@ class Protocol(object):
                 #random corruption
                 packet = self.corrupt_array(packet)
                 #print("Single byte corruption")
+        write_time = time.perf_counter()
         self.port.write(packet)
+        self.metrics.write_time += time.perf_counter() - write_time
+        self.metrics.packets += 1
+        self.metrics.wire_bytes += len(packet)
         self.transmit_attempt += 1
 
+    def packet_buffer(self, size):
+        # One buffer per sync slot, a packet is never overwritten while it may still need resending.
+        # The slot count is a power of two above the window size, so slots stay distinct when sync wraps at 256
+        index = self.sync % len(self.packet_buffers)
+        if len(self.packet_buffers[index]) < size:
+            self.packet_buffers[index] = bytearray(size)
+        return self.packet_buffers[index]
+
     def build_packet(self, protocol, packet_type, data = bytearray()):
         PACKET_TOKEN = 0xB5AD
 
         if len(data) > self.max_block_size:
             raise PayloadOverflow()
 
-        packet_buffer = bytearray()
-
-        packet_buffer += self.pack_int8(self.sync)                           # 8bit sync id
-        packet_buffer += self.pack_int4_2(protocol, packet_type)             # 4 bit protocol id, 4 bit packet type
-        packet_buffer += self.pack_int16(len(data))                          # 16bit packet length
-        packet_buffer += self.pack_int16(self.build_checksum(packet_buffer)) # 16bit header checksum
+        length = len(data)
+        size = 8 + (length + 2 if length else 0)
+        buffer = self.packet_buffer(size)
+        packet = memoryview(buffer)[:size]
 
-        if len(data):
-            packet_buffer += data
-            packet_buffer += self.pack_int16(self.build_checksum(packet_buffer))
+        # 16bit start token, 8bit sync id, 4 bit protocol id, 4 bit packet type, 16bit packet length
+        struct.pack_into('<HBBH', buffer, 0, PACKET_TOKEN, self.sync, ((protocol & 0xF) << 4) | (packet_type & 0xF), length)
+        struct.pack_into('<H', buffer, 6, self.build_checksum(packet[2:6]))    # 16bit header checksum, start token not included
 
-        packet_buffer =  self.pack_int16(PACKET_TOKEN) + packet_buffer       # 16bit start token, not included in checksum
-        return packet_buffer
+        if length:
+            packet[8:8 + length] = data
+            # timed once per packet here, build_checksum() itself stays free of the bookkeeping
+            checksum_time = time.perf_counter()
+            checksum = self.build_checksum(packet[2:8 + length])
+            self.metrics.checksum_time += time.perf_counter() - checksum_time
+            struct.pack_into('<H', buffer, 8 + length, checksum)
+        return packet
 
     # checksum 16 fletchers
     def checksum(self, cs, value):
         cs_low = (((cs & 0xFF) + value) % 255)
         return ((((cs >> 8) + cs_low) % 255) << 8) | cs_low
 
+    # Same result as folding checksum() over every byte, without a call per byte:
+    # the low byte is the sum of the data, the high byte the sum of the running sums
     def build_checksum(self, buffer):
-        cs = 0
-        for b in buffer:
-            cs = self.checksum(cs, b)
-        return cs
+        if numpy_exists and len(buffer) >= 128:
+            data = numpy.frombuffer(buffer, dtype = numpy.uint8).astype(numpy.uint64)
+            cs_low = int(data.sum())
+            cs_high = int(numpy.dot(data, numpy.arange(len(data), 0, -1, dtype = numpy.uint64)))
+        else:
+            cs_low = sum(buffer)
+            cs_high = sum(itertools.accumulate(buffer))
+        return ((cs_high % 255) << 8) | (cs_low % 255)
 
     def pack_int32(self, value):
         return value.to_bytes(4, byteorder='little')
@@ -261,8 +441,78 @@ class Protocol(object):
 
     def disconnect(self):
         self.send(0, 2)
+        self.flush()
         self.syncronised = False
 
+    def list_files(self):
+        # The client media as {path: size} from 'M20 L', under the 8.3 and the long name. Listing lines
+        # are '<8.3 path> <size>[ <long path>]'. ASCII only, so before connect() or after disconnect().
+        listing = []
+        def collect(response):
+            listing.append(response[1])
+        self.register([''], collect)
+        try:
+            self.send_ascii("M20 L")
+        finally:
+            self.unregister(collect)
+        return parse_listing(listing)
+
+    def resync(self):
+        # The SYNC control packet is answered whatever state the client stream is in, 'ss' reports the
+        # sync id the client expects next. Answers to packets still on the way, earlier sync probes
+        # included, are let through first so they can't be taken for the answer.
+        try:
+            while True:
+                self.responses.get(timeout = self.response_timeout / 1000)
+        except queue.Empty:
+            pass
+        timeout = TimeOut(self.response_timeout * 20)
+        while not timeout.timedout():
+            self.transmit_packet(self.build_packet(0, 1))
+            try:
+                while True:
+                    token, data = self.responses.get(timeout = self.response_timeout / 1000)
+                    if token == 'ss':
+                        self.sync = int(data.split(',')[0])
+                        return self.sync
+            except queue.Empty:
+                self.errors += 1
+                self.metrics.timeouts += 1
+        raise ConnectionLost()
+
+    def unconfirmed(self):
+        # Packets sent but not acknowledged yet, copied out of the packet buffers
+        if self.inflight:
+            pending = [(sync, bytes(packet)) for sync, packet in self.inflight]
+        elif self.packet_transit is not None:
+            pending = [(self.sync, bytes(self.packet_transit))]
+        else:
+            pending = []
+        self.inflight.clear()
+        self.packet_transit = None
+        return pending
+
+    def resume_point(self, pending, expected, failed = None):
+        # After a fatal error the client stream starts over at sync 0 and 'failed' is the first packet it
+        # dropped, otherwise the sync answer tells where it stopped. Everything before that arrived.
+        if failed is None:
+            failed = expected
+        elif expected != 0:
+            # packets already in flight behind the failed one matched the restarted stream, the file has a gap
+            raise SycronisationError()
+        lost = next((index for index, (sync, _) in enumerate(pending) if sync == failed), len(pending))
+        return [(packet[3] >> 4, packet[3] & 0xF, packet[8:8 + (packet[4] | (packet[5] << 8))]) for sync, packet in pending[lost:]]
+
+    def resume(self, failed = None):
+        # Continue the stream after a fatal error or a stalled link, resending only the packets the
+        # client never confirmed. Returns the number of payload bytes resent.
+        pending = self.unconfirmed()
+        resent = 0
+        for protocol, packet_type, data in self.resume_point(pending, self.resync(), failed):
+            self.send(protocol, packet_type, data)
+            resent += len(data)
+        return resent
+
     def response_ok(self, data):
         try:
             packet_id = int(data)
@@ -276,6 +526,7 @@ class Protocol(object):
     def response_resend(self, data):
         packet_id = int(data)
         self.errors += 1
+        self.metrics.resends += 1
         if not self.syncronised:
             print("Retrying syncronisation")
         elif packet_id != self.sync:
@@ -292,10 +543,378 @@ class Protocol(object):
         print("Connection synced [{0}], binary protocol version {1}, {2} byte payload buffer".format(self.sync, self.protocol_version, self.max_block_size))
 
     def response_fatal_error(self, data):
-        raise FatalError()
+        # the client reset its stream, data is the sync id of the packet it gave up on
+        raise FatalError(data)
+
+    def window_ok(self, data):
+        try:
+            packet_id = int(data)
+        except ValueError:
+            return
+        for index, (sync, _) in enumerate(self.inflight):
+            if sync == packet_id:
+                if self.send_times[sync] is not None:
+                    rtt = time.perf_counter() - self.send_times[sync]
+                    self.srtt = rtt if self.srtt is None else self.srtt * 0.875 + rtt * 0.125
+                    self.metrics.add_rtt(rtt)
+                # acknowledgements arrive in order, so this covers every packet before it too
+                for _ in range(index + 1):
+                    self.inflight.popleft()
+                self.window_timeout.reset()
+                self.resend_fence = self.resending = False
+                return
+        # duplicate acknowledgement for a retransmitted packet, nothing to do
+
+    def window_resend(self, data):
+        packet_id = int(data)
+        self.errors += 1
+        self.metrics.resends += 1
+        # Packets already on their way behind a bad one can ask for it again, the resend covers those
+        if packet_id == self.resend_sync and self.resend_fence:
+            return
+        self.retransmit_window(packet_id)
+
+    def window_stream_sync(self, data):
+        sync, max_block_size, protocol_version = data.split(',')
+        sync = int(sync)
+        # the fence of a resend that is still on its way, its packets will be answered
+        if self.resend_fence and sync == self.resend_sync:
+            self.resend_fence = False
+            return
+        self.retransmit_window(sync)
+
+
+class BlockSizeController(object):
+    # Adapts the payload size to the link by measuring it. Goodput, payload bytes over the time it took to get
+    # them through with resends and timeouts, is measured per block size over periods of packets. After a period
+    # with errors the next one tries half the size, after a clean one twice the size, and the size that moved
+    # more bytes a second is kept. A try that didn't pay off waits twice as long before it is made again.
+    min_block_size = 64
+    period = 32         # packets per measurement
+    max_backoff = 32    # periods between tries at most
+
+    def __init__(self, block_size, adaptive = False):
+        self.max_block_size = block_size
+        self.block_size = block_size
+        self.adaptive = adaptive
+        self.base = block_size          # the size kept, block_size differs from it while another is tried
+        self.throughput = {}            # block size: bytes per millisecond, exponential average over periods
+        self.backoff = {}               # block size: periods to wait before it is tried again
+        self.wait = 0
+        self.reset()
+
+    def reset(self):
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+        self.elapsed = 0
+
+    def update(self, size, errors, elapsed):
+        if not self.adaptive:
+            return
+        self.packets += 1
+        self.bytes += size
+        self.errors += errors
+        self.elapsed += elapsed
+        if self.packets < self.period:
+            return
+
+        rate = self.bytes / max(self.elapsed, 0.001)
+        previous = self.throughput.get(self.block_size)
+        self.throughput[self.block_size] = rate if previous is None else previous * 0.5 + rate * 0.5
+        errors = self.errors
+        self.reset()
+
+        if self.block_size != self.base:
+            # end of a try, keep whichever size was faster
+            tried, self.block_size = self.block_size, self.base
+            if self.throughput[tried] > self.throughput.get(self.base, 0):
+                self.base = self.block_size = tried
+                self.backoff.pop(tried, None)
+            else:
+                self.backoff[tried] = min(self.backoff.get(tried, 1) * 2, self.max_backoff)
+                self.wait = self.backoff[tried]
+            return
+
+        if self.wait:
+            self.wait -= 1
+            return
+        if errors:
+            candidate = max(self.base // 2, min(self.min_block_size, self.max_block_size))
+        else:
+            candidate = min(self.base * 2, self.max_block_size)
+        if candidate != self.base:
+            self.block_size = candidate
+
+
+class StreamCompressor(object):
+    # Compresses a source file on a worker thread and hands out compressed blocks as soon as they fill up,
+    # so the serial link does not wait for the whole image to be compressed. With on_image the worker keeps
+    # the whole image and runs ahead of the link, on_image is called with it once it is done, or with None
+    # when compression failed or was stopped.
+    chunk_size = 16384
+    queue_depth = 64
+
+    def __init__(self, source, block_size, window, lookahead, on_image = None):
+        self.source = source
+        self.block_size = block_size
+        self.encoder = heatshrink.core.Encoder(heatshrink.core.Writer(window_sz2=window, lookahead_sz2=lookahead))
+        self.on_image = on_image
+        self.compressed = queue.Queue(0 if on_image else self.queue_depth)
+        self.stopped = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.position = 0 # source bytes covered by the blocks handed out so far
+        self.busy = 0     # seconds spent compressing
+        self.image = bytearray() if on_image else None  # the whole compressed image once the worker is done
+
+        self.worker_thread = threading.Thread(target=StreamCompressor.compress_worker, args=(self,), daemon=True)
+        self.worker_thread.start()
+
+    def ratio(self):
+        return self.bytes_in / self.bytes_out if self.bytes_out else 1
+
+    def compress_worker(self):
+        pending = bytearray()
+
+        def emit(final):
+            while len(pending) >= self.block_size or (final and len(pending)):
+                block = bytes(pending[:self.block_size])
+                del pending[:self.block_size]
+                self.bytes_out += len(block)
+                if self.image is not None:
+                    self.image += block
+                self.compressed.put((block, self.bytes_in))
+
+        try:
+            with self.source:
+                chunk = self.source.read(self.chunk_size)
+                while chunk and not self.stopped:
+                    self.bytes_in += len(chunk)
+                    busy = time.perf_counter()
+                    pending += self.encoder.fill(chunk)
+                    self.busy += time.perf_counter() - busy
+                    emit(False)
+                    chunk = self.source.read(self.chunk_size)
+            if not self.stopped:
+                busy = time.perf_counter()
+                pending += self.encoder.finish()
+                self.busy += time.perf_counter() - busy
+                emit(True)
+            if self.on_image:
+                self.on_image(None if self.stopped else bytes(self.image))
+            self.compressed.put(None)
+        except Exception as e:
+            if self.on_image:
+                self.on_image(None)
+            self.compressed.put(e)
+
+    def __iter__(self):
+        try:
+            item = self.compressed.get()
+            while item is not None:
+                if isinstance(item, Exception):
+                    raise item
+                block, self.position = item
+                yield block
+                item = self.compressed.get()
+        finally:
+            self.close()
+
+    def close(self):
+        self.stopped = True
+        # drain the queue so a worker blocked on a full queue can see it has to stop
+        while self.worker_thread.is_alive():
+            try:
+                self.compressed.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+class CompressionCache(object):
+    # Compresses each source once per set of heatshrink parameters, uploads to several boards share the result.
+    # With a directory the images are also kept on disk, named by the SHA-256 of the source and the parameters,
+    # so re-flashing an unchanged build skips compression. Least recently used images go first once the cache
+    # grows over max_size bytes, images unused for max_age seconds are removed. get() compresses a missing
+    # image in one go, a streamed upload claims it and settles it with what it compressed on the way. Only
+    # the first miss compresses an image, the others wait for it.
+    def __init__(self, directory = None, max_size = 64 * 1024 * 1024, max_age = 30 * 24 * 3600):
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.images = {}
+        self.compressing = {}   # key: threading.Event set once the image being compressed is settled
+        self.hits = 0
+        self.compressions = 0
+        self.lock = threading.RLock()
+
+    def digest(self, filename):
+        return file_digest(filename)
+
+    def key(self, filename, window, lookahead):
+        return (self.digest(filename), window, lookahead)
+
+    def path(self, key):
+        return os.path.join(self.directory, "{}-{}-{}.hs".format(*key))
+
+    def get(self, filename, window, lookahead):
+        key = self.key(filename, window, lookahead)
+        image = self.claim(key)
+        if image is None:
+            image = self.compress(key, filename)
+        return image
+
+    def claim(self, key):
+        # The image, or None when the caller is to compress it and settle() the key. A miss for an image
+        # another caller is compressing waits for that one, and compresses it itself when it failed.
+        while True:
+            with self.lock:
+                image = self.lookup(key)
+                if image is not None:
+                    return image
+                done = self.compressing.get(key)
+                if done is None:
+                    self.compressing[key] = threading.Event()
+                    self.compressions += 1
+                    return None
+            done.wait()
+
+    def compress(self, key, filename):
+        # compress a claimed image in one go
+        image = None
+        try:
+            with open(filename, "rb") as source:
+                image = heatshrink.encode(source.read(), window_sz2=key[1], lookahead_sz2=key[2])
+        finally:
+            self.settle(key, image)
+        return image
+
+    def settle(self, key, image):
+        # end a claim, with the compressed image or None when there is none
+        if image is not None:
+            self.put(key, image)
+        with self.lock:
+            done = self.compressing.pop(key, None)
+        if done:
+            done.set()
+
+    def lookup(self, key):
+        # None when the image was never compressed
+        with self.lock:
+            if key not in self.images:
+                image = self.load(key)
+                if image is None:
+                    return None
+                self.images[key] = image
+            self.hits += 1
+            return self.images[key]
+
+    def put(self, key, image):
+        with self.lock:
+            self.images[key] = image
+            self.store(key, image)
+
+    def load(self, key):
+        if not self.directory: return None
+        try:
+            with open(self.path(key), "rb") as cached:
+                image = cached.read()
+            os.utime(self.path(key))     # mark as recently used
+            return image
+        except OSError:
+            return None
+
+    def store(self, key, image):
+        if not self.directory: return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            temp = "{}.{}.tmp".format(self.path(key), os.getpid())
+            with open(temp, "wb") as cached:
+                cached.write(image)
+            os.replace(temp, self.path(key))
+            self.evict()
+        except OSError as e:
+            print("Compression cache not written: {}".format(e))
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".hs"): continue
+            stat = os.stat(os.path.join(self.directory, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_size and now - mtime <= self.max_age: break
+            try:
+                os.remove(os.path.join(self.directory, name))
+                total -= size
+            except OSError:
+                pass
+
+
+class TransferMetrics(object):
+    # What a transfer cost. The protocol counts packets, resends, timeouts and acknowledgement round trips and times
+    # checksums and serial writes, FileTransferProtocol.copy() fills in the file side. Round trips of packets that
+    # were sent once go into power of two buckets, rtt[i] counts the ones acknowledged in under 2**i ms.
+    # Times are seconds. Compression runs next to the transfer when streamed, so the times don't add up to elapsed.
+    rtt_buckets = 16
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.result = None          # 'complete', 'failed' or 'aborted' once the transfer ended
+        self.source_size = 0        # bytes of the file
+        self.source_sent = 0        # bytes of the file covered by the payload sent so far
+        self.payload_sent = 0       # payload bytes handed to the protocol, compressed if compression is on
+        self.wire_bytes = 0         # bytes written to the port, framing, control packets and resends included
+        self.packets = 0
+        self.resends = 0
+        self.timeouts = 0
+        self.resumes = 0
+        self.rtt = [0] * self.rtt_buckets
+        self.checksum_time = 0
+        self.compress_time = 0
+        self.write_time = 0
+
+    def add_rtt(self, seconds):
+        self.rtt[min(int(seconds * 1000).bit_length(), self.rtt_buckets - 1)] += 1
+
+    def rtt_percentile(self, fraction):
+        # upper bound in ms of the bucket the fraction of round trips falls in, None without samples
+        target = fraction * sum(self.rtt)
+        count = 0
+        for bucket, samples in enumerate(self.rtt):
+            count += samples
+            if samples and count >= target:
+                return 2 ** bucket
+        return None
+
+    def elapsed(self):
+        return (self.end_time or time.perf_counter()) - self.start_time
+
+    def kibs(self):
+        # effective: file bytes a second, what the user waits for. raw: payload bytes a second over the link
+        elapsed = max(self.elapsed(), 0.001)
+        return self.source_sent / 1024 / elapsed, self.payload_sent / 1024 / elapsed
+
+    def ratio(self):
+        return self.source_sent / self.payload_sent if self.payload_sent else 1
+
+    def summary(self):
+        effective, raw = self.kibs()
+        return {'result': self.result, 'elapsed': self.elapsed(), 'source_size': self.source_size, 'source_sent': self.source_sent,
+                'payload_sent': self.payload_sent, 'wire_bytes': self.wire_bytes, 'kibs': effective, 'raw_kibs': raw, 'ratio': self.ratio(),
+                'packets': self.packets, 'resends': self.resends, 'timeouts': self.timeouts, 'resumes': self.resumes,
+                'rtt': list(self.rtt), 'rtt_p50': self.rtt_percentile(0.5), 'rtt_p99': self.rtt_percentile(0.99),
+                'checksum_time': self.checksum_time, 'compress_time': self.compress_time, 'write_time': self.write_time}
 
 
 class FileTransferProtocol(object):
+    # The transfers, copy(), send_file() and sync(), are written once as generators and shared with the asyncio
+    # client. Each step that talks to the client is yielded as the name of the method doing it with its arguments,
+    # run() calls it and hands back its result or throws in its exception. The asyncio client awaits the same steps.
     protocol_id = 1
 
     class Packet(object):
@@ -305,24 +924,72 @@ class FileTransferProtocol(object):
         WRITE = 3
         ABORT = 4
 
-    responses = deque()
-    def __init__(self, protocol, timeout = None):
-        protocol.register(['PFT:success', 'PFT:version:', 'PFT:fail', 'PFT:busy', 'PFT:ioerror', 'PTF:invalid'], self.process_input)
+    responses = None
+    status_line = False
+    def __init__(self, protocol, timeout = None, adaptive = False, max_errors = 256, max_error_rate = 4, max_resumes = 3, on_event = None):
+        self.responses = queue.Queue()
+        protocol.register(['PFT:success', 'PFT:version:', 'PFT:fail', 'PFT:busy', 'PFT:ioerror', 'PFT:invalid', 'PTF:invalid'], self.process_input)
         self.protocol = protocol
         self.response_timeout = timeout or protocol.response_timeout
+        self.adaptive = adaptive        # adapt the block size to the link quality
+        self.max_errors = max_errors    # protocol errors tolerated before a transfer is abandoned, unless it still
+        self.max_error_rate = max_error_rate  # gets a packet through for every max_error_rate of them
+        self.max_resumes = max_resumes  # link failures a transfer recovers from before it is abandoned
+        self.on_event = on_event        # called with (event, TransferMetrics) as a copy goes on
+        self.resumes = 0
+        self.metrics = TransferMetrics()
+
+    def report(self, event):
+        # 'start', 'progress' at every tenth of the file, 'resume', then 'complete', 'failed' or 'aborted'
+        if event in ('complete', 'failed', 'aborted'):
+            self.metrics.result = event
+            self.metrics.end_time = time.perf_counter()
+        if self.on_event:
+            self.on_event((event, self.metrics))
+
+    def show(self, status, final = False):
+        # the transfer status rewrites one line, messages start below it
+        print("\r" + status, end = '\n' if final else '')
+        self.status_line = not final
+
+    def message(self, text):
+        if self.status_line:
+            print("")
+            self.status_line = False
+        print(text)
+
+    def run(self, steps):
+        # an interrupt leaves the steps through their finally blocks too
+        result = error = None
+        try:
+            while True:
+                try:
+                    name, *args = steps.throw(error) if error else steps.send(result)
+                except StopIteration as done:
+                    return done.value
+                try:
+                    result, error = getattr(self, name)(*args), None
+                except Exception as e:
+                    result, error = None, e
+        finally:
+            steps.close()
+
+    def blocking(self, function, *args):
+        # a step that may take a while, the asyncio client runs it on a worker thread
+        return function(*args)
 
     def process_input(self, data):
         #print(data)
-        self.responses.append(data)
+        self.responses.put(data)
 
     def await_response(self, timeout = None):
-        timeout = TimeOut(timeout or self.response_timeout)
-        while not len(self.responses):
-            time.sleep(0.0001)
-            if timeout.timedout():
-                raise ReadTimeout()
+        # File transfer responses follow the acknowledgement of the packet that caused them
+        self.protocol.flush()
 
-        return self.responses.popleft()
+        try:
+            return self.responses.get(timeout = (timeout or self.response_timeout) / 1000)
+        except queue.Empty:
+            raise ReadTimeout()
 
     def connect(self):
         self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.QUERY)
@@ -330,7 +997,9 @@ class FileTransferProtocol(object):
         token, data = self.await_response()
         if token != 'PFT:version:':
             return False
+        self.parse_version(data)
 
+    def parse_version(self, data):
         self.version, _, compression = data.split(':')
         if compression != 'none':
             algorithm, window, lookahead = compression.split(',')
@@ -338,24 +1007,30 @@ class FileTransferProtocol(object):
         else:
             self.compression = {'algorithm': 'none'}
 
-        print("File Transfer version: {0}, compression: {1}".format(self.version, self.compression['algorithm']))
+        self.message("File Transfer version: {0}, compression: {1}".format(self.version, self.compression['algorithm']))
 
-    def open(self, filename, compression, dummy):
+    def open_payload(self, filename, compression, dummy):
         payload =  b'\1' if dummy else b'\0'          # dummy transfer
         payload += b'\1' if compression else b'\0'    # payload compression
         payload += bytearray(filename, 'utf8') + b'\0'# target filename + null terminator
+        return payload
+
+    def open(self, filename, compression, dummy, sent = False):
+        # 'sent' when the OPEN packet already went out and only its answer is awaited
+        payload = self.open_payload(filename, compression, dummy)
 
         timeout = TimeOut(5000)
         token = None
-        self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
+        if not sent:
+            self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
         while token != 'PFT:success' and not timeout.timedout():
             try:
                 token, data = self.await_response(1000)
                 if token == 'PFT:success':
-                    print(filename,"opened")
+                    self.message("{0} opened".format(filename))
                     return
                 elif token == 'PFT:busy':
-                    print("Broken transfer detected, purging")
+                    self.message("Broken transfer detected, purging")
                     self.abort()
                     time.sleep(0.1)
                     self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
@@ -366,76 +1041,475 @@ class FileTransferProtocol(object):
                 pass
         raise ReadTimeout()
 
+    def send(self, packet_type, data = bytearray()):
+        self.protocol.send(FileTransferProtocol.protocol_id, packet_type, data)
+
     def write(self, data):
         self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.WRITE, data)
 
-    def close(self):
-        self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.CLOSE)
+    def flush(self):
+        self.protocol.flush()
+
+    def close(self, sent = False):
+        if not sent:
+            self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.CLOSE)
         token, data = self.await_response(1000)
+        return self.close_result(token)
+
+    def close_result(self, token):
         if token == 'PFT:success':
-            print("File closed")
+            self.message("File closed")
             return True
         elif token == 'PFT:ioerror':
-            print("Client storage device IO error")
+            self.message("Client storage device IO error")
             return False
         elif token == 'PFT:invalid':
-            print("No open file")
+            self.message("No open file")
             return False
 
     def abort(self):
         self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.ABORT)
         token, data = self.await_response()
         if token == 'PFT:success':
-            print("Transfer Aborted")
-
-    def copy(self, filename, dest_filename, compression, dummy):
-        self.connect()
+            self.message("Transfer Aborted")
+
+    def resume(self, error, position):
+        # The client keeps an interrupted file open for a few seconds, resynchronise and carry on from
+        # the last packet it confirmed instead of restarting the upload. 'position' counts the bytes
+        # handed to the protocol so far.
+        while True:
+            self.resumes += 1
+            failed = int(error.args[0]) if isinstance(error, FatalError) and error.args else None
+            try:
+                resent = self.protocol.resume(failed)
+                break
+            except (FatalError, ConnectionLost) as retry_error:
+                if self.resumes >= self.max_resumes or not self.protocol.connected:
+                    raise
+                error = retry_error
+        self.message("Link failure, transfer resumed at byte {0}".format(position - resent))
+
+    def write_error(self):
+        # Writes are only answered when the client could not store them
+        try:
+            token, data = self.responses.get_nowait()
+        except queue.Empty:
+            return None
+        return token
+
+    def blocks(self, data, block_size):
+        view = memoryview(data)
+        for start in range(0, len(view), block_size):
+            yield view[start:start + block_size]
+
+    def stream_blocks(self, source, block_size):
+        # Memory map the source, or when that isn't possible read it block by block into a single buffer.
+        # write() copies each block into its packet, so the buffer can be refilled as soon as it returns
+        with source:
+            try:
+                data = mmap.mmap(source.fileno(), 0, access = mmap.ACCESS_READ)
+            except (ValueError, OSError):
+                buffer = bytearray(block_size)
+                view = memoryview(buffer)
+                count = source.readinto(buffer)
+                while count:
+                    yield view[:count]
+                    count = source.readinto(buffer)
+            else:
+                yield from self.blocks(data, block_size)
 
+    def supported_compression(self, compression):
         has_heatshrink = heatshrink_exists and self.compression['algorithm'] == 'heatshrink'
         if compression and not has_heatshrink:
             hs = '2' if sys.version_info[0] > 2 else ''
-            print("Compression not supported by client. Use 'pip install heatshrink%s' to fix." % hs)
-            compression = False
+            self.message("Compression not supported by client. Use 'pip install heatshrink%s' to fix." % hs)
+            return False
+        return compression
 
-        data = open(filename, "rb").read()
-        filesize = len(data)
+    def copy(self, filename, dest_filename, compression, dummy, stream = False, cache = None):
+        return self.run(self.copy_steps(filename, dest_filename, compression, dummy, stream, cache))
 
-        self.open(dest_filename, compression, dummy)
+    def send_file(self, filename, source, compression, stream = False, cache = None):
+        return self.run(self.send_file_steps(filename, source, compression, stream, cache))
 
-        block_size = self.protocol.block_size
-        if compression:
-            data = heatshrink.encode(data, window_sz2=self.compression['window'], lookahead_sz2=self.compression['lookahead'])
+    def sync(self, files, compression, listing = None, manifest = None, cache = None):
+        return self.run(self.sync_steps(files, compression, listing, manifest, cache))
+
+    def copy_steps(self, filename, dest_filename, compression, dummy, stream, cache):
+        yield ('connect',)
+        compression = self.supported_compression(compression)
+
+        with open(filename, "rb") as source:
+            yield ('open', dest_filename, compression, dummy)
+            if not (yield from self.send_file_steps(filename, source, compression, stream, cache)):
+                return False
+
+        if not (yield ('close',)):
+            self.message("Transfer failed")
+            self.report('failed')
+            return False
+        self.message("Transfer complete")
+        self.report('complete')
+        return True
 
-        cratio = filesize / len(data)
+    def send_file_steps(self, filename, source, compression, stream = False, cache = None):
+        # Payload of a file opened on the client, up to the confirmation of its last packet.
+        # False when the transfer was given up, the client file is aborted or closed by then.
+        filesize = os.fstat(source.fileno()).st_size
+        self.resumes = 0
+        metrics = self.metrics = self.protocol.metrics = TransferMetrics()
+        metrics.source_size = filesize
+        self.report('start')
+
+        block_size = self.protocol.block_size
+        compressor = None
+        compress_time = time.perf_counter()
+        image = key = None
+        if compression and cache:
+            # an image compressed before is sent as it is, a new one is compressed as it is sent when the
+            # heatshrink build can and kept for the next time
+            window, lookahead = self.compression['window'], self.compression['lookahead']
+            key = yield ('blocking', cache.key, filename, window, lookahead)
+            image = yield ('blocking', cache.claim, key)
+            if image is None and not heatshrink_streaming:
+                image = yield ('blocking', cache.compress, key, filename)
+        if image is not None:
+            source.close()
+            metrics.compress_time = time.perf_counter() - compress_time
+            datasize = len(image)
+            source_blocks = self.blocks(image, block_size)
+        elif compression and heatshrink_streaming:
+            compressor = StreamCompressor(source, block_size, self.compression['window'], self.compression['lookahead'], on_image = (lambda image: cache.settle(key, image)) if key is not None else None)
+            datasize = filesize
+            source_blocks = iter(compressor)
+        elif stream and not compression:
+            datasize = filesize
+            source_blocks = self.stream_blocks(source, block_size)
+        else:
+            with source:
+                data = source.read()
+            if compression:
+                # this heatshrink build can only compress the whole image in one go
+                data = heatshrink.encode(data, window_sz2=self.compression['window'], lookahead_sz2=self.compression['lookahead'])
+                metrics.compress_time = time.perf_counter() - compress_time
+            datasize = len(data)
+            source_blocks = self.blocks(data, block_size)
 
-        blocks = math.floor((len(data) + block_size - 1) / block_size)
-        kibs = 0
         dump_pctg = 0
-        start_time = millis()
-        for i in range(blocks):
-            start = block_size * i
-            end = start + block_size
-            self.write(data[start:end])
-            kibs = (( (i+1) * block_size) / 1024) / (millis() + 1 - start_time) * 1000
-            if (i / blocks) >= dump_pctg:
-                print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format((i / blocks) * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors), end='')
+        sent = 0
+        progress = 0
+        packets = 0
+        start_errors = self.protocol.errors
+        sizer = BlockSizeController(block_size, self.adaptive)
+        def status():
+            kibs, raw_kibs = metrics.kibs()
+            return "{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3} Block: {4}".format(progress * 100, raw_kibs, "[{0:4.2f}KiB/s, ratio {1:3.2f}]".format(kibs, metrics.ratio()) if compression else "", self.protocol.errors - start_errors, sizer.block_size)
+
+        while True:
+            # the compressor hands blocks over from its worker thread
+            block = (yield ('blocking', next, source_blocks, None)) if compressor else next(source_blocks, None)
+            if block is None:
+                break
+            # Source blocks are cut to the size the link currently copes with, resent packets
+            # and timeouts are retried by the protocol and only shrink the following packets
+            view = memoryview(block)
+            offset = 0
+            while offset < len(view):
+                packet = view[offset:offset + sizer.block_size]
+                errors = self.protocol.errors
+                packet_start = millis()
+                try:
+                    yield ('write', packet)
+                except (FatalError, ConnectionLost) as error:
+                    if self.resumes >= self.max_resumes or not self.protocol.connected:
+                        raise
+                    # A windowed send fails before queueing the new packet, stop-and-wait resends it with the rest
+                    windowed = self.protocol.windowed()
+                    yield ('resume', error, sent + offset + (0 if windowed else len(packet)))
+                    metrics.resumes = self.resumes
+                    self.report('resume')
+                    if windowed:
+                        continue
+                sizer.update(len(packet), self.protocol.errors - errors, millis() - packet_start)
+                offset += len(packet)
+                packets += 1
+            sent += len(view)
+            error = self.write_error()
+            if error:
+                self.message("Client answered {0}, transfer aborted".format(error))
+                source_blocks.close()
+                yield ('abort',)
+                self.report('aborted')
+                return False
+            if compressor:
+                progress = compressor.position / filesize if filesize else 1
+                metrics.compress_time = compressor.busy
+            else:
+                progress = sent / datasize
+            metrics.payload_sent = sent
+            metrics.source_sent = int(progress * filesize)
+            if progress >= dump_pctg:
+                self.show(status())
+                self.report('progress')
                 dump_pctg += 0.1
-            if self.protocol.errors > 0:
+            transfer_errors = self.protocol.errors - start_errors
+            if transfer_errors > self.max_errors and transfer_errors > packets * self.max_error_rate:
                 # Dump last status (errors may not be visible)
-                print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3} - Aborting...".format((i / blocks) * 100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors), end='')
-                print("")   # New line to break the transfer speed line
-                self.close()
-                print("Transfer aborted due to protocol errors")
-                #raise Exception("Transfer aborted due to protocol errors")
+                self.show(status() + " - Aborting...", True)
+                source_blocks.close()
+                yield ('close',)
+                self.message("Transfer aborted due to protocol errors")
+                self.report('aborted')
                 return False
-        print("\r{0:2.0f}% {1:4.2f}KiB/s {2} Errors: {3}".format(100, kibs, "[{0:4.2f}KiB/s]".format(kibs * cratio) if compression else "", self.protocol.errors)) # no one likes transfers finishing at 99.8%
-
-        if not self.close():
-            print("Transfer failed")
-            return False
-        print("Transfer complete")
+        # The file can only be closed once the client confirmed every packet
+        while True:
+            try:
+                yield ('flush',)
+                break
+            except (FatalError, ConnectionLost) as error:
+                if self.resumes >= self.max_resumes or not self.protocol.connected:
+                    raise
+                yield ('resume', error, sent)
+                metrics.resumes = self.resumes
+                self.report('resume')
+        progress = 1
+        metrics.source_sent = filesize
+        self.show(status(), True) # no one likes transfers finishing at 99.8%
         return True
 
+    def sync_steps(self, files, compression, listing, manifest, cache):
+        # Send a set of files in one session. (source, target) pairs whose target the client already has are
+        # skipped: 'listing' is the client media as Protocol.list_files() reports it, 'manifest' maps the
+        # targets of earlier syncs to [size, sha256] and is updated for every file sent. Marlin can't hash its
+        # files, so without a manifest a matching size is taken as a match. A CLOSE is queued right behind the
+        # last packet with the next OPEN after it, their answers are collected once both are on their way.
+        # Returns {target: 'skipped' | 'sent' | 'failed'}.
+        listing = {name.upper(): size for name, size in (listing or {}).items()}
+        yield ('connect',)
+        compression = self.supported_compression(compression)
+
+        results = {}
+        closing = None
+        def closed():
+            ok = yield ('close', True)
+            results[closing[0]] = 'sent' if ok else 'failed'
+            if ok and manifest is not None:
+                manifest[closing[0]] = closing[1]
+            self.report('complete' if ok else 'failed')
+
+        for filename, target in files:
+            size = os.path.getsize(filename)
+            digest = (yield ('blocking', file_digest, filename)) if manifest is not None else None
+            if listing.get(target.upper()) == size and (manifest is None or manifest.get(target) == [size, digest]):
+                self.message("{0} is up to date".format(target))
+                results[target] = 'skipped'
+                continue
+
+            with open(filename, "rb") as source:
+                yield ('send', FileTransferProtocol.Packet.OPEN, self.open_payload(target, compression, False))
+                if closing:
+                    yield from closed()
+                    closing = None
+                yield ('open', target, compression, False, True)
+                if not (yield from self.send_file_steps(filename, source, compression, cache = cache)):
+                    results[target] = 'failed'
+                    continue
+            yield ('send', FileTransferProtocol.Packet.CLOSE)
+            closing = (target, [size, digest])
+        if closing:
+            yield from closed()
+        return results
+
+
+class GCodeStreamer(object):
+    # Streams G-code in ASCII mode as fast as the client takes it. Lines are numbered and checksummed, so the
+    # client can reject a damaged or missing line and ask for it again with 'Resend: N'. Marlin answers every
+    # line it received with exactly one 'ok', rejected ones included, so the lines in flight are the lines sent
+    # minus the 'ok's seen. Up to buffer_size of them wait in the client command queue (BUFSIZE), more only while
+    # they fit its serial receive buffer (RX_BUFFER_SIZE). ADVANCED_OK replies ('ok N12 P15 B3') raise
+    # buffer_size to what the client reports. Lines come from any iterable and are only read as they are sent.
+    # A line counts as sent once an 'ok' accepted it. The client takes lines strictly in order, so an accepted
+    # line also accepts every line before it.
+    history_size = 1024
+
+    def __init__(self, protocol, buffer_size = 4, rx_buffer_size = 128, timeout = 5000, max_timeouts = 3):
+        self.protocol = protocol
+        self.buffer_size = buffer_size
+        self.rx_buffer_size = rx_buffer_size
+        self.timeout = timeout      # ms without any answer before a line is taken as lost
+        self.max_timeouts = max_timeouts    # timeouts in a row without any answer before the link is taken as lost
+        self.responses = queue.Queue()
+        self.pending = deque()      # (line number, size) sent and not answered yet, oldest first
+        self.commands = deque()     # numbers of the streamed commands not accepted yet
+        self.accepted = 0           # highest line number the client accepted
+        self.rejected = 0           # 'ok's still to come for rejected lines
+        self.history = {}           # line number: line as sent, for resend requests
+        self.number = 0             # last line number used
+        self.next_line = 1          # line to send next, below number + 1 while resending
+        self.resend_line = None
+        self.stale = 0              # resend requests still to come from lines sent after a rejected one
+        self.tickled = False
+        self.silent = 0             # timeouts since the last answer
+        self.lines = 0
+        self.resends = 0
+        self.timeouts = 0
+        self.planner_free = None
+        self.buffer_free = None
+
+    def process_input(self, data):
+        self.responses.put(data)
+
+    def checksum(self, data):
+        cs = 0
+        for c in data:
+            cs ^= c
+        return cs
+
+    def send_line(self, number, command):
+        data = "N{0} {1}".format(number, command).encode('utf8')
+        data += "*{0}\n".format(self.checksum(data)).encode('utf8')
+        self.history[number] = data
+        self.history.pop(number - self.history_size, None)
+        self.transmit(number)
+
+    def transmit(self, number):
+        data = self.history[number]
+        try:
+            self.protocol.port.write(data)
+        except serial.SerialException:
+            raise ConnectionLost()
+        self.pending.append((number, len(data)))
+
+    def room(self, size):
+        # lines past the command queue sit in the receive buffer until a command is taken from the queue
+        if len(self.pending) < self.buffer_size:
+            return True
+        return sum(size for _, size in itertools.islice(self.pending, self.buffer_size, None)) + size < self.rx_buffer_size
+
+    def accept(self, number):
+        self.accepted = max(self.accepted, number)
+        while self.commands and self.commands[0] <= self.accepted:
+            self.commands.popleft()
+            self.lines += 1
+
+    def response_ok(self, data):
+        number = self.pending.popleft()[0] if self.pending else None
+        self.tickled = False
+        # the 'ok' after a resend request answers a rejected line
+        if self.rejected:
+            self.rejected -= 1
+            number = None
+        # ADVANCED_OK: ' N<line> P<free planner blocks> B<free command slots>'
+        for field in data.split():
+            if field[:1] == 'N' and field[1:].isdigit():
+                number = int(field[1:])
+            elif field[:1] == 'P' and field[1:].isdigit():
+                self.planner_free = int(field[1:])
+            elif field[:1] == 'B' and field[1:].isdigit():
+                self.buffer_free = int(field[1:])
+                self.buffer_size = max(self.buffer_size, self.buffer_free + 1)
+        if number is not None:
+            self.accept(number)
+
+    def response_resend(self, data):
+        try:
+            number = int(data.strip().lstrip('N:').split()[0])
+        except (ValueError, IndexError):
+            return
+        self.rejected += 1
+        # every line sent behind a rejected one is rejected too, each asks for the same line again
+        if number == self.resend_line and self.stale > 0:
+            self.stale -= 1
+            return
+        if number not in self.history:
+            raise SycronisationError()
+        self.accept(number - 1)
+        self.resends += 1
+        self.resend_line = number
+        self.stale = max(self.next_line - 1 - number, 0)
+        self.next_line = number
+
+    def response_error(self, data):
+        # errors about a line are followed by a resend request, the others mean the client stopped
+        if 'halted' in data or 'stopped' in data.lower():
+            raise FatalError(data)
+
+    def await_response(self):
+        try:
+            token, data = self.responses.get(timeout = self.timeout / 1000)
+        except queue.Empty:
+            # A lost 'ok' or a line that never arrived, two lines run together by a damaged newline are one
+            # line to the client. Nothing answered in this long is nothing in flight, a client busy with a long
+            # move says so with 'echo:busy:'. The next line, or a numbered M105 when there is none, is answered
+            # either way or makes the client ask for the missing one. A client that stays silent is gone.
+            self.timeouts += 1
+            self.silent += 1
+            if self.silent >= self.max_timeouts:
+                raise ConnectionLost()
+            self.stale = 0
+            self.rejected = 0
+            self.pending.clear()
+            if not self.tickled:
+                self.tickled = True
+                if self.next_line > self.number:
+                    self.number += 1
+                    self.send_line(self.number, "M105")
+                else:
+                    self.transmit(self.next_line)
+                self.next_line += 1
+            return
+        self.silent = 0
+        if token == 'ok':
+            self.response_ok(data)
+        elif token in ('Resend:', 'rs'):
+            self.response_resend(data)
+        elif token == 'Error:':
+            self.response_error(data)
+        elif token == '!!':
+            raise FatalError(data)
+
+    def stream(self, lines):
+        # Send every command of 'lines', comments and blank lines dropped, and wait until the client answered
+        # them all. Returns the number of commands sent, raises ConnectionLost when the client stops answering;
+        # 'lines' then holds the number of commands the client accepted.
+        self.protocol.register(['ok', 'rs', 'ss', 'fe'], self.process_input)
+        self.protocol.register(['Resend:', 'Error:', '!!', 'echo:busy:'], self.process_input)
+        try:
+            self.send_line(0, "M110 N0")   # the client takes its line number from a numbered M110
+            commands = iter(lines)
+            while True:
+                while not self.responses.empty() or (self.pending and not self.room(96)):
+                    self.await_response()
+                if self.next_line <= self.number:
+                    # resending, the history holds every line a client can ask for
+                    data = self.history[self.next_line]
+                    while not self.room(len(data)):
+                        self.await_response()
+                    if self.next_line <= self.number and self.history.get(self.next_line) == data:
+                        self.transmit(self.next_line)
+                        self.next_line += 1
+                    continue
+                command = next(commands, None)
+                if command is None:
+                    break
+                command = command.split(';', 1)[0].strip()
+                if not command:
+                    continue
+                self.number += 1
+                self.commands.append(self.number)
+                self.send_line(self.number, command)
+                self.next_line = self.number + 1
+            while self.pending or self.next_line <= self.number or self.commands:
+                if self.next_line <= self.number and self.room(len(self.history[self.next_line])):
+                    self.transmit(self.next_line)
+                    self.next_line += 1
+                else:
+                    self.await_response()
+        finally:
+            self.protocol.unregister(self.process_input)
+            self.protocol.register(['ok', 'rs', 'ss', 'fe'], self.protocol.process_input)
+        return self.lines
+
 
 class EchoProtocol(object):
     def __init__(self, protocol):
@@ -0,0 +1,414 @@
+#
+# MarlinBinaryProtocolAsync.py
+# asyncio client for the Marlin binary protocol, one event loop can drive many serial ports at once.
+# Packet format, sync handling and file transfer tokens are shared with MarlinBinaryProtocol.
+# The serial ports are serviced with the event loop's reader/writer callbacks, which needs a POSIX host.
+#
+#   async def flash(device):
+#       protocol = Protocol(device, 115200, 512, 0, 1000)
+#       await protocol.open()
+#       await protocol.connect()
+#       await FileTransferProtocol(protocol).copy('firmware.bin', 'FIRMWARE.BIN', True, False)
+#       await protocol.disconnect()
+#       await protocol.shutdown()
+#
+#   await asyncio.gather(*(flash(device) for device in devices))
+#
+import asyncio, os, time
+import serial
+
+import MarlinBinaryProtocol
+from MarlinBinaryProtocol import TimeOut, ReadTimeout, FatalError, ConnectionLost
+
+class SerialPort(object):
+    # pySerial opens the port non-blocking, reads and writes are done as the descriptor becomes ready
+    max_buffered = 16384
+
+    def __init__(self, loop, device, baud, on_data, on_lost):
+        self.port = serial.Serial(device, baudrate = baud, write_timeout = 0, timeout = 0)
+        self.port.reset_input_buffer()
+        self.fd = self.port.fileno()
+        self.loop = loop
+        self.on_data = on_data
+        self.on_lost = on_lost
+        self.outgoing = bytearray()
+        self.writable = asyncio.Event()
+        self.writable.set()
+        self.closed = False
+        loop.add_reader(self.fd, self.read_ready)
+
+    def read_ready(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if data:
+            self.on_data(data)
+        else:
+            # readable without data, the device went away
+            self.close()
+            self.on_lost()
+
+    def write(self, data):
+        if self.closed:
+            raise ConnectionLost()
+        if not len(self.outgoing):
+            try:
+                written = os.write(self.fd, data)
+            except BlockingIOError:
+                written = 0
+            except OSError:
+                raise ConnectionLost()
+            if written == len(data):
+                return
+            data = data[written:]
+            self.loop.add_writer(self.fd, self.write_ready)
+        self.outgoing += data
+        if len(self.outgoing) > self.max_buffered:
+            self.writable.clear()
+
+    def write_ready(self):
+        try:
+            written = os.write(self.fd, self.outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close()
+            self.on_lost()
+            return
+        del self.outgoing[:written]
+        if len(self.outgoing) <= self.max_buffered:
+            self.writable.set()
+        if not len(self.outgoing):
+            self.loop.remove_writer(self.fd)
+
+    async def drain(self):
+        await self.writable.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.fd)
+        self.loop.remove_writer(self.fd)
+        self.writable.set()
+        self.port.close()
+
+
+class Protocol(MarlinBinaryProtocol.Protocol):
+    # Packet building and response handling come from the threaded Protocol,
+    # everything that waits on the serial port is a coroutine here
+    def start(self):
+        # the port and the responses queue are set up by open(), on the event loop that uses them
+        pass
+
+    async def open(self):
+        self.responses = asyncio.Queue()
+        self.port = SerialPort(asyncio.get_running_loop(), self.device, self.baud, self.receive, self.lost)
+        self.connected = True
+
+    async def shutdown(self):
+        self.connected = False
+        if self.port: self.port.close()
+
+    def lost(self):
+        print("{0}: Connection lost".format(self.device))
+        self.connected = False
+        self.responses.put_nowait(None)
+
+    def process_input(self, data):
+        self.responses.put_nowait(data)
+
+    async def get_response(self, responses, timeout):
+        if not self.connected:
+            raise ConnectionLost()
+        try:
+            response = await asyncio.wait_for(responses.get(), timeout / 1000)
+        except asyncio.TimeoutError:
+            raise ReadTimeout()
+        if response is None:
+            raise ConnectionLost()
+        return response
+
+    async def send(self, protocol, packet_type, data = bytearray()):
+        if self.windowed():
+            await self.send_windowed(protocol, packet_type, data)
+            return
+
+        self.packet_transit = self.build_packet(protocol, packet_type, data)
+        self.packet_status = 0
+        self.transmit_attempt = 0
+
+        timeout = TimeOut(self.response_timeout * 20)
+        send_time = time.perf_counter()
+        while self.packet_status == 0:
+            try:
+                if timeout.timedout():
+                    raise ConnectionLost()
+                self.transmit_packet(self.packet_transit)
+                await self.await_response()
+            except ReadTimeout:
+                self.errors += 1
+                self.metrics.timeouts += 1
+        if self.transmit_attempt == 1:
+            self.metrics.add_rtt(time.perf_counter() - send_time)
+        self.packet_transit = None
+
+    async def await_response(self, timeout = None):
+        response = await self.get_response(self.responses, timeout or self.response_timeout)
+        while response:
+            token, data = response
+            if self.windowed():
+                switch = {'ok' : self.window_ok, 'rs': self.window_resend, 'ss' : self.window_stream_sync, 'fe' : self.response_fatal_error}
+            else:
+                switch = {'ok' : self.response_ok, 'rs': self.response_resend, 'ss' : self.response_stream_sync, 'fe' : self.response_fatal_error}
+            switch[token](data)
+            response = None if self.responses.empty() else self.responses.get_nowait()
+
+    async def send_windowed(self, protocol, packet_type, data = bytearray()):
+        while len(self.inflight) >= self.window_size:
+            await self.await_window()
+
+        if not len(self.inflight):
+            self.window_timeout.reset()
+        packet = self.build_packet(protocol, packet_type, data)
+        self.inflight.append((self.sync, packet))
+        self.send_times[self.sync] = time.perf_counter()
+        self.sync = (self.sync + 1) % 256
+        self.transmit_attempt = 0
+        self.transmit_packet(packet)
+        # writes only queue the packet, the wait for the port to take it counts as writing
+        write_time = time.perf_counter()
+        await self.port.drain()
+        self.metrics.write_time += time.perf_counter() - write_time
+
+    async def await_window(self):
+        if self.window_timeout.timedout():
+            raise ConnectionLost()
+        try:
+            await self.await_response(self.window_response_timeout())
+        except ReadTimeout:
+            self.errors += 1
+            self.metrics.timeouts += 1
+            self.resend_fence = self.resending = False
+            self.transmit_packet(self.build_packet(0, 1))
+
+    async def flush(self):
+        while len(self.inflight):
+            await self.await_window()
+
+    async def send_ascii(self, data, send_and_forget = False):
+        self.packet_transit = bytearray(data, "utf8") + b'\n'
+        self.packet_status = 0
+        self.transmit_attempt = 0
+
+        timeout = TimeOut(self.response_timeout * 20)
+        while self.packet_status == 0:
+            try:
+                if timeout.timedout():
+                    return
+                self.port.write(self.packet_transit)
+                if send_and_forget:
+                    self.packet_status = 1
+                else:
+                    await self.get_response(self.responses, self.response_timeout)
+                    self.packet_status = 1
+            except ReadTimeout:
+                self.errors += 1
+                self.metrics.timeouts += 1
+        self.packet_transit = None
+
+    async def connect(self):
+        print("{0}: Switching Marlin to Binary Protocol...".format(self.device))
+        await self.send_ascii("M28B1")
+        await self.send(0, 1)
+
+    async def disconnect(self):
+        await self.send(0, 2)
+        await self.flush()
+        self.syncronised = False
+
+    async def list_files(self):
+        listing = []
+        def collect(response):
+            listing.append(response[1])
+        self.register([''], collect)
+        try:
+            await self.send_ascii("M20 L")
+        finally:
+            self.unregister(collect)
+        return MarlinBinaryProtocol.parse_listing(listing)
+
+    async def resync(self):
+        try:
+            while True:
+                await self.get_response(self.responses, self.response_timeout)
+        except ReadTimeout:
+            pass
+        timeout = TimeOut(self.response_timeout * 20)
+        while not timeout.timedout():
+            self.transmit_packet(self.build_packet(0, 1))
+            try:
+                while True:
+                    token, data = await self.get_response(self.responses, self.response_timeout)
+                    if token == 'ss':
+                        self.sync = int(data.split(',')[0])
+                        return self.sync
+            except ReadTimeout:
+                self.errors += 1
+                self.metrics.timeouts += 1
+        raise ConnectionLost()
+
+    async def resume(self, failed = None):
+        pending = self.unconfirmed()
+        resent = 0
+        for protocol, packet_type, data in self.resume_point(pending, await self.resync(), failed):
+            await self.send(protocol, packet_type, data)
+            resent += len(data)
+        return resent
+
+    def response_stream_sync(self, data):
+        sync, max_block_size, protocol_version = data.split(',')
+        self.sync = int(sync)
+        self.max_block_size = int(max_block_size)
+        self.block_size = self.max_block_size if self.max_block_size < self.block_size else self.block_size
+        self.protocol_version = protocol_version
+        self.packet_status = 1
+        self.syncronised = True
+        print("{0}: Connection synced [{1}], binary protocol version {2}, {3} byte payload buffer".format(self.device, self.sync, self.protocol_version, self.max_block_size))
+
+
+class FileTransferProtocol(MarlinBinaryProtocol.FileTransferProtocol):
+    # The transfers are the generators of the threaded class, every step of them is awaited here
+    def __init__(self, protocol, *args, **kwargs):
+        super().__init__(protocol, *args, **kwargs)
+        self.responses = None
+
+    def response_queue(self):
+        # Made on first use, from the event loop that runs the transfer: before Python 3.10 a queue
+        # binds to the loop that is current when it is made
+        if self.responses is None:
+            self.responses = asyncio.Queue()
+        return self.responses
+
+    def process_input(self, data):
+        self.response_queue().put_nowait(data)
+
+    def show(self, status, final = False):
+        print("{0}: {1}".format(self.protocol.device, status))
+
+    def message(self, text):
+        print("{0}: {1}".format(self.protocol.device, text))
+
+    async def run(self, steps):
+        result = error = None
+        try:
+            while True:
+                try:
+                    name, *args = steps.throw(error) if error else steps.send(result)
+                except StopIteration as done:
+                    return done.value
+                try:
+                    result, error = await getattr(self, name)(*args), None
+                except Exception as e:
+                    result, error = None, e
+        finally:
+            steps.close()
+
+    async def blocking(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(None, function, *args)
+
+    async def await_response(self, timeout = None):
+        await self.protocol.flush()
+        return await self.protocol.get_response(self.response_queue(), timeout or self.response_timeout)
+
+    async def connect(self):
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.QUERY)
+
+        token, data = await self.await_response()
+        if token != 'PFT:version:':
+            return False
+        self.parse_version(data)
+
+    async def open(self, filename, compression, dummy, sent = False):
+        payload = self.open_payload(filename, compression, dummy)
+
+        timeout = TimeOut(5000)
+        token = None
+        if not sent:
+            await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
+        while token != 'PFT:success' and not timeout.timedout():
+            try:
+                token, data = await self.await_response(1000)
+                if token == 'PFT:success':
+                    self.message("{0} opened".format(filename))
+                    return
+                elif token == 'PFT:busy':
+                    self.message("Broken transfer detected, purging")
+                    await self.abort()
+                    await asyncio.sleep(0.1)
+                    await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.OPEN, payload)
+                    timeout.reset()
+                elif token == 'PFT:fail':
+                    raise Exception("Can not open file on client")
+            except ReadTimeout:
+                pass
+        raise ReadTimeout()
+
+    async def send(self, packet_type, data = bytearray()):
+        await self.protocol.send(FileTransferProtocol.protocol_id, packet_type, data)
+
+    async def write(self, data):
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.WRITE, data)
+
+    async def flush(self):
+        await self.protocol.flush()
+
+    async def close(self, sent = False):
+        if not sent:
+            await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.CLOSE)
+        token, data = await self.await_response(1000)
+        return self.close_result(token)
+
+    async def abort(self):
+        await self.protocol.send(FileTransferProtocol.protocol_id, FileTransferProtocol.Packet.ABORT)
+        token, data = await self.await_response()
+        if token == 'PFT:success':
+            self.message("Transfer Aborted")
+
+    async def resume(self, error, position):
+        while True:
+            self.resumes += 1
+            failed = int(error.args[0]) if isinstance(error, FatalError) and error.args else None
+            try:
+                resent = await self.protocol.resume(failed)
+                break
+            except (FatalError, ConnectionLost) as retry_error:
+                if self.resumes >= self.max_resumes or not self.protocol.connected:
+                    raise
+                error = retry_error
+        self.message("Link failure, transfer resumed at byte {0}".format(position - resent))
+
+    def write_error(self):
+        responses = self.response_queue()
+        return None if responses.empty() else responses.get_nowait()[0]
+
+    async def copy(self, filename, dest_filename, compression, dummy, stream = False, cache = None):
+        return await self.run(self.copy_steps(filename, dest_filename, compression, dummy, stream, cache))
+
+    async def send_file(self, filename, source, compression, stream = False, cache = None):
+        return await self.run(self.send_file_steps(filename, source, compression, stream, cache))
+
+    async def sync(self, files, compression, listing = None, manifest = None, cache = None):
+        return await self.run(self.sync_steps(files, compression, listing, manifest, cache))
+
+
+class EchoProtocol(object):
+    def __init__(self, protocol):
+        protocol.register(['echo:'], self.process_input)
+        self.protocol = protocol
+
+    def process_input(self, data):
+        print("{0}: {1}".format(self.protocol.device, data))
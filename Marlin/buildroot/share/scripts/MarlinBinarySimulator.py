@@ -0,0 +1,730 @@
+#
+# MarlinBinarySimulator.py
+# Stand-in for the firmware side of the binary file transfer protocol (feature/binary_stream.h) served on a pty,
+# so MarlinBinaryProtocol can be exercised and benchmarked without a board. Needs a POSIX host.
+#
+#   python MarlinBinarySimulator.py                                  # benchmark suite on an unthrottled link
+#   python MarlinBinarySimulator.py --baud 250000 --latency 2 --corrupt 0.0001 --window 1 8
+#   python MarlinBinarySimulator.py --lines 200                      # response dispatch line rate
+#   python MarlinBinarySimulator.py --wait --latency 2               # CPU of queued against sleep-polled response waits
+#   python MarlinBinarySimulator.py --checksum 4                     # packet checksum rate, per implementation and size
+#   python MarlinBinarySimulator.py --check                          # protocol checks, exits non-zero on a failure
+#   python MarlinBinarySimulator.py --serve                          # print the pty path and answer until Ctrl-C
+#
+import argparse, os, sys, io, re, json, time, threading, random, select, hashlib, itertools, functools, operator, tty, contextlib, multiprocessing, asyncio, tempfile
+
+import MarlinBinaryProtocol, MarlinBinaryProtocolAsync
+
+class Firmware(object):
+    # Client of the binary protocol, behaves like binary_stream.h down to its quirks:
+    # a lost 'ok' is only repeated for sync - 1 as an int (never while sync is 0), out of order
+    # packets after a resend request are dropped silently, and unknown file transfer packets
+    # are answered with 'PTF:invalid'
+    version = '0.1.0'
+    packet_max_wait = 500       # ms without data before a started packet is given up and resent
+    transfer_timeout = 10000    # ms without file transfer packets before an open file is aborted
+    token = b'\xAD\xB5'
+
+    def __init__(self, buffer_size = 512, baud = 0, latency = 0, corrupt = 0, max_retries = 0, compression = (8, 4), advanced_ok = False, bufsize = 4):
+        self.buffer_size = buffer_size      # payload buffer, bigger packets are a fatal error
+        self.baud = baud                    # emulated link speed, 10 bits a byte. 0 = unthrottled
+        self.latency = latency              # ms the client spends on a packet or a G command before it answers 'ok'
+        self.advanced_ok = advanced_ok      # 'ok N<line> P<planner> B<buffer>' instead of 'ok'
+        self.bufsize = bufsize              # command queue slots reported by ADVANCED_OK
+        self.corrupt = corrupt              # probability of a byte arriving corrupted
+        self.max_retries = max_retries      # resend requests for one packet before 'fe'. 0 = unlimited, as shipped
+        self.compression = compression if compression and MarlinBinaryProtocol.heatshrink_exists else None
+
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.path = os.ttyname(self.slave)
+
+        self.files = {}
+        self.stats = {'packets': 0, 'payload': 0, 'resends': 0, 'timeouts': 0, 'fatal': 0, 'commands': 0, 'line_errors': 0}
+        self.commands = hashlib.sha256()    # every command run, numbered lines without their number and checksum
+        self.last_n = 0
+        self.binary_mode = False
+        self.sync = 0
+        self.packet_retries = 0
+        self.transfer = None
+        self.transfer_deadline = 0
+        self.incoming = bytearray()
+        self.rx_clock = 0
+        self.next_corruption = self.corruption_distance()
+        self.running = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.running = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+        os.close(self.master)
+        os.close(self.slave)
+
+    def corruption_distance(self):
+        return int(random.expovariate(self.corrupt)) if self.corrupt else -1
+
+    def send(self, line):
+        os.write(self.master, (line + '\n').encode())
+
+    def chatter(self, data):
+        # unsolicited output, as much as the pty takes
+        view = memoryview(data)
+        while len(view):
+            view = view[os.write(self.master, view[:4096]):]
+
+    def fill(self, timeout):
+        # Read what the host sent within timeout seconds, applying the link emulation
+        ready, _, _ = select.select([self.master], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            data = bytearray(os.read(self.master, 4096))
+        except OSError:
+            self.running = False
+            return False
+        while 0 <= self.next_corruption < len(data):
+            data[self.next_corruption] ^= 1 << random.randrange(8)
+            self.next_corruption += 1 + self.corruption_distance()
+        if self.next_corruption >= 0:
+            self.next_corruption -= len(data)
+        if self.baud:
+            now = time.monotonic()
+            self.rx_clock = max(self.rx_clock, now) + len(data) * 10 / self.baud
+            if self.rx_clock > now:
+                time.sleep(self.rx_clock - now)
+        self.incoming += data
+        return True
+
+    def read(self, count):
+        # count bytes of a started packet, None when it stalls for packet_max_wait
+        while len(self.incoming) < count:
+            if not self.running or not self.fill(self.packet_max_wait / 1000):
+                return None
+        data = bytes(self.incoming[:count])
+        del self.incoming[:count]
+        return data
+
+    def checksum(self, data, cs = 0):
+        # fletcher 16 as in binary_stream.h, in closed form: the low byte sums the data, the high byte the running sums
+        low, high = cs & 0xFF, cs >> 8
+        high += len(data) * low + sum(itertools.accumulate(data))
+        low += sum(data)
+        return ((high % 255) << 8) | (low % 255)
+
+    def run(self):
+        while self.running:
+            if self.binary_mode:
+                self.receive_packet()
+            else:
+                self.receive_line()
+
+    #-------------#
+    # ASCII mode  #
+    #-------------#
+    def receive_line(self):
+        end = self.incoming.find(b'\n')
+        while end < 0:
+            if not self.running:
+                return
+            if not self.fill(0.05):
+                self.idle()
+            end = self.incoming.find(b'\n')
+        line = bytes(self.incoming[:end]).decode('utf8', 'replace').strip()
+        del self.incoming[:end + 1]
+        if line.startswith('N') or '*' in line:
+            line = self.check_line(line)
+        if line:
+            self.gcode(line)
+
+    def check_line(self, line):
+        # As queue.cpp: the number follows the last one, except for M110 which sets it, and the checksum is the
+        # xor of everything before the '*'. A checksum needs a line number, a line whose 'N' was damaged is not run.
+        # A bad line is answered with an error, a resend request and 'ok'.
+        data, star, checksum = line.partition('*')
+        match = re.match(r'N(\d+)\s*(.*)', data)
+        number = int(match.group(1)) if match else -1
+        m110 = re.search(r'M110\s*N(\d+)', data)
+        if m110:
+            number = int(m110.group(1))
+        if not line.startswith('N'):
+            error = 'No Line Number with checksum'
+        elif not star:
+            error = 'No Checksum with line number'
+        elif number != self.last_n + 1 and not m110:
+            error = 'Line Number is not Last Line Number+1'
+        elif not checksum.isdigit() or int(checksum) != functools.reduce(operator.xor, data.encode('utf8'), 0):
+            error = 'checksum mismatch'
+        else:
+            self.last_n = number
+            return match.group(2).strip()
+        self.stats['line_errors'] += 1
+        self.send('Error:{0}, Last Line: {1}'.format(error, self.last_n))
+        self.send('Resend: {0}'.format(self.last_n + 1))
+        self.send(self.ok())
+        return None
+
+    def ok(self):
+        return 'ok N{0} P{1} B{2}'.format(self.last_n, 16, self.bufsize - 1) if self.advanced_ok else 'ok'
+
+    def gcode(self, line):
+        # the command word ends at its number, 'M28B1' is M28 with argument B1
+        match = re.match(r'([GMT]\d+)\s*(.*)', line)
+        command, argument = match.groups() if match else (line, '')
+        self.stats['commands'] += 1
+        self.commands.update(line.encode('utf8') + b'\n')
+        if command[:1] == 'G' and self.latency:
+            time.sleep(self.latency / 1000)
+        if command == 'M28' and argument.startswith('B1'):
+            self.send('echo:Switching to Binary Protocol')
+            self.binary_mode = True
+            self.sync = 0
+            self.packet_retries = 0
+        elif command == 'M21':
+            self.send('echo:SD card ok')
+        elif command == 'M20':
+            self.send('Begin file list')
+            for name, data in self.files.items():
+                self.send('{0} {1}{2}'.format(name.upper(), len(data), ' ' + name if 'L' in argument else ''))
+            self.send('End file list')
+        elif command == 'M30':
+            name = argument.lstrip('/')
+            match = next((stored for stored in self.files if stored.upper() == name.upper()), None)
+            if match is not None:
+                del self.files[match]
+                self.send('File deleted:' + name)
+            else:
+                self.send('Deletion failed, File: {0}.'.format(name))
+        self.send(self.ok())
+
+    #--------------#
+    # Binary mode  #
+    #--------------#
+    def receive_packet(self):
+        # wait for the start token, dropping anything else
+        while True:
+            if self.incoming[:2] == self.token:
+                break
+            start = self.incoming.find(self.token)
+            if start > 0:
+                del self.incoming[:start]
+                continue
+            del self.incoming[:max(len(self.incoming) - 1, 0)]
+            if not self.running or not self.binary_mode:
+                return
+            if not self.fill(0.05):
+                self.idle()
+        del self.incoming[:2]
+
+        header = self.read(6)
+        if header is None:
+            return self.packet_timeout()
+        sync, meta, size = header[0], header[1], header[2] | (header[3] << 8)
+        cs = self.checksum(header[:4])
+        if cs != (header[4] | (header[5] << 8)):
+            self.send('echo:Packet header({0}?) corrupt'.format(sync))
+            return self.resend(sync)
+
+        if meta == 0x01:
+            # the SYNC control packet doesn't need the stream to be in sync
+            self.send('ss{0},{1},{2}'.format(self.sync, self.buffer_size, self.version))
+            return
+        if sync != self.sync:
+            if sync == self.sync - 1:
+                self.send('ok{0}'.format(sync))         # ok response must have been lost
+            elif not self.packet_retries:
+                self.send('echo:Datastream packet out of order')
+                self.resend(sync)
+            return                                      # already asked for a resend, drop the packet
+
+        payload = b''
+        if size:
+            if size > self.buffer_size:
+                self.send('echo:Datastream packet data buffer overrun')
+                return self.fatal_error(sync)
+            payload = self.read(size + 2)
+            if payload is None:
+                return self.packet_timeout()
+            # the payload checksum carries on from the whole header, its checksum bytes included
+            if self.checksum(payload[:size], self.checksum(header)) != (payload[size] | (payload[size + 1] << 8)):
+                self.send('echo:Packet({0}) payload corrupt'.format(sync))
+                return self.resend(sync)
+            payload = payload[:size]
+
+        self.sync = (self.sync + 1) % 256
+        self.packet_retries = 0
+        self.stats['packets'] += 1
+        self.stats['payload'] += size
+        if self.latency:
+            time.sleep(self.latency / 1000)
+        self.send('ok{0}'.format(sync))
+        self.dispatch(meta >> 4, meta & 0xF, payload)
+
+    def packet_timeout(self):
+        self.stats['timeouts'] += 1
+        self.send('echo:Datastream timeout')
+        self.resend(self.sync)
+
+    def resend(self, sync):
+        if self.packet_retries < self.max_retries or self.max_retries == 0:
+            self.packet_retries += 1
+            self.stats['resends'] += 1
+            self.send('echo:Resend request {0}'.format(self.packet_retries))
+            self.send('rs{0}'.format(self.sync))
+        else:
+            self.fatal_error(sync)
+
+    def fatal_error(self, sync):
+        self.stats['fatal'] += 1
+        self.send('fe{0}'.format(sync))
+        self.sync = 0
+        self.packet_retries = 0
+
+    def dispatch(self, protocol, packet_type, payload):
+        if protocol == 0:
+            if packet_type == 2:
+                self.binary_mode = False                # revert back to ASCII mode
+            else:
+                self.send('echo:Unknown BinaryProtocolControl Packet')
+        elif protocol == MarlinBinaryProtocol.FileTransferProtocol.protocol_id:
+            self.file_transfer(packet_type, payload)
+        else:
+            self.send('echo:Unsupported Binary Protocol')
+
+    #----------------#
+    # File transfer  #
+    #----------------#
+    def file_transfer(self, packet_type, payload):
+        Packet = MarlinBinaryProtocol.FileTransferProtocol.Packet
+        self.transfer_deadline = time.monotonic() + self.transfer_timeout / 1000
+        if packet_type == Packet.QUERY:
+            compression = 'heatshrink,{0},{1}'.format(*self.compression) if self.compression else 'none'
+            self.send('PFT:version:{0}:compression:{1}'.format(self.version, compression))
+        elif packet_type == Packet.OPEN:
+            if self.transfer:
+                self.send('PFT:busy')
+            elif len(payload) > 3 and payload[-1] == 0:
+                self.transfer = {'dummy': bool(payload[0] & 1), 'compression': bool(payload[1] & 1) and self.compression is not None,
+                                 'name': payload[2:-1].decode('utf8', 'replace'), 'data': bytearray()}
+                self.send('PFT:success')
+            else:
+                self.send('PFT:fail')
+        elif packet_type == Packet.CLOSE:
+            if self.transfer:
+                self.send('PFT:success' if self.close() else 'PFT:ioerror')
+            else:
+                self.send('PFT:invalid')
+        elif packet_type == Packet.WRITE:
+            if not self.transfer:
+                self.send('PFT:invalid')
+            elif not self.transfer['dummy']:
+                self.transfer['data'] += payload
+        elif packet_type == Packet.ABORT:
+            self.transfer = None
+            self.send('PFT:success')
+        else:
+            self.send('PTF:invalid')
+
+    def close(self):
+        transfer, self.transfer = self.transfer, None
+        if transfer['dummy']:
+            return True
+        data = bytes(transfer['data'])
+        if transfer['compression']:
+            try:
+                data = MarlinBinaryProtocol.heatshrink.decode(data, window_sz2=self.compression[0], lookahead_sz2=self.compression[1])
+            except Exception:
+                return False
+        self.files[transfer['name']] = data
+        return True
+
+    def idle(self):
+        # an interrupted transfer is aborted once it saw no packets for transfer_timeout
+        if self.transfer and time.monotonic() > self.transfer_deadline:
+            self.transfer = None
+
+
+#------------#
+# Benchmarks #
+#------------#
+def serve(connection, options):
+    # Runs the firmware in its own process, so its CPU time stays out of the host measurement
+    firmware = Firmware(**options).start()
+    connection.send(firmware.path)
+    while True:
+        request = connection.recv()
+        if request == 'stats':
+            connection.send(dict(firmware.stats))
+        elif request == 'files':
+            connection.send({name: hashlib.sha256(data).hexdigest() for name, data in firmware.files.items()})
+        elif request == 'chatter':
+            firmware.chatter(chatter_stream(connection.recv()))
+        else:
+            break
+    firmware.stop()
+
+def bench_data(size):
+    # Firmware images compress to about half, mix incompressible and repetitive data the same way
+    rng = random.Random(size)
+    data = bytearray()
+    while len(data) < size:
+        data += rng.getrandbits(8 * 1024).to_bytes(1024, 'little') if rng.random() < 0.5 else bytes([rng.randrange(4)]) * 1024
+    return bytes(data[:size])
+
+# What a printing board sends unasked: auto reported temperatures and positions, busy and error echoes
+chatter_lines = [b'ok', b' T:210.00 /210.00 B:60.00 /60.00 @:127 B@:0', b'ok T:210.00 /210.00 B:60.00 /60.00 @:127 B@:0',
+                 b'echo:busy: processing', b'X:10.00 Y:20.00 Z:0.30 E:0.00 Count X:800 Y:1600 Z:120', b'echo:Unknown command: "M9999"']
+
+def chatter_stream(count):
+    rng = random.Random(count)
+    return b''.join(rng.choice(chatter_lines) + b'\r\n' for _ in range(count)) + b'PFT:success\r\n'
+
+def bench_lines(test, module, protocol, parent, count):
+    # The tokens of a file transfer session with echo output, each handler swapped for a counter.
+    # The closing 'PFT:success' ends the run
+    handled = [0]
+    done = threading.Event()
+    def counter(response):
+        handled[0] += 1
+        if response[0] == 'PFT:success':
+            done.set()
+    module.FileTransferProtocol(protocol)
+    module.EchoProtocol(protocol)
+    for tokens, _ in protocol.applications:
+        protocol.register(tokens, counter)
+
+    stream = None if parent else memoryview(chatter_stream(count))
+    start_time, start_cpu = time.time(), time.process_time()
+    if parent:
+        parent.send('chatter')
+        parent.send(count)
+    else:
+        for offset in range(0, len(stream), 4096):
+            protocol.receive(stream[offset:offset + 4096].tobytes())
+    done.wait(60)
+    elapsed, cpu = time.time() - start_time, time.process_time() - start_cpu
+    return {'test': test, 'lines': count, 'klines': count / 1000 / elapsed, 'cpu': cpu * 1e6 / count, 'handled': handled[0],
+            'result': 'ok' if done.is_set() else 'timeout'}
+
+class PollingProtocol(MarlinBinaryProtocol.Protocol):
+    # Waits for responses the way Protocol did before receive_worker handed them over on a queue,
+    # checking every 10 us. Only there to measure what the blocking wait saves.
+    def await_response(self, timeout = None):
+        deadline = MarlinBinaryProtocol.TimeOut(timeout or self.response_timeout)
+        while self.responses.empty():
+            time.sleep(0.00001)
+            if deadline.timedout():
+                raise MarlinBinaryProtocol.ReadTimeout()
+        super().await_response(timeout)
+
+def reference_checksum(protocol, data):
+    # build_checksum as it was, checksum() folded over every byte
+    cs = 0
+    for b in data:
+        cs = protocol.checksum(cs, b)
+    return cs
+
+@contextlib.contextmanager
+def numpy_checksum(enabled):
+    # build_checksum takes the numpy path for 128 bytes and more when numpy is there
+    available = MarlinBinaryProtocol.numpy_exists
+    MarlinBinaryProtocol.numpy_exists = available and enabled
+    try:
+        yield MarlinBinaryProtocol.numpy_exists
+    finally:
+        MarlinBinaryProtocol.numpy_exists = available
+
+def bench_checksum(mib):
+    # MiB/s and CPU us per packet of each implementation over header, small and full payload packets
+    protocol = MarlinBinaryProtocolAsync.Protocol(None, 0, 512, 0, 1000)
+    rows = []
+    for size in (4, 64, 512):
+        data = memoryview(bench_data(size))
+        count = max(int(mib * 1024 * 1024 / size), 1)
+        for name, numpy in (('reference', False), ('accumulate', False), ('numpy', True)):
+            with numpy_checksum(numpy) as enabled:
+                if numpy and not enabled:
+                    continue
+                function = functools.partial(reference_checksum, protocol) if name == 'reference' else protocol.build_checksum
+                runs = count // 16 if name == 'reference' else count
+                start_cpu = time.process_time()
+                for _ in range(runs):
+                    function(data)
+                cpu = max(time.process_time() - start_cpu, 1e-9)
+            rows.append({'test': name, 'size': size, 'mibs': runs * size / 1024 / 1024 / cpu, 'cpu': cpu * 1e6 / runs})
+    return rows
+
+def bench(args, window, mode, data, source, protocol_class = MarlinBinaryProtocol.Protocol):
+    parent, child = multiprocessing.Pipe()
+    options = {'buffer_size': args.buffer, 'baud': args.baud, 'latency': args.latency, 'corrupt': args.corrupt}
+    process = multiprocessing.Process(target=serve, args=(child, options), daemon=True)
+    process.start()
+    path = parent.recv()
+
+    output = sys.stdout if args.verbose else io.StringIO()
+    result = 'ok'
+    with contextlib.redirect_stdout(output):
+        protocol = protocol_class(path, args.baud or 115200, args.block, 0, args.timeout, window)
+        start_time, start_cpu = time.time(), time.process_time()
+        try:
+            protocol.connect()
+            filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol, adaptive = args.adaptive)
+            if mode == 'protocol':
+                # raw packet layer, a dummy transfer keeps the client from storing anything
+                filetransfer.connect()
+                filetransfer.open('BENCH.BIN', False, True)
+                protocol.metrics = MarlinBinaryProtocol.TransferMetrics()
+                view = memoryview(data)
+                for offset in range(0, len(view), protocol.block_size):
+                    protocol.send(filetransfer.protocol_id, filetransfer.Packet.WRITE, view[offset:offset + protocol.block_size])
+                result = 'ok' if filetransfer.close() else 'failed'
+            else:
+                if not filetransfer.copy(source, 'BENCH.BIN', mode == 'heatshrink', False):
+                    result = 'failed'
+            elapsed, cpu = time.time() - start_time, time.process_time() - start_cpu
+            protocol.disconnect()
+        except Exception as e:
+            elapsed, cpu = time.time() - start_time, time.process_time() - start_cpu
+            result = type(e).__name__
+        protocol.shutdown()
+
+    parent.send('stats')
+    stats = parent.recv()
+    if mode != 'protocol' and result == 'ok':
+        parent.send('files')
+        if parent.recv().get('BENCH.BIN') != hashlib.sha256(data).hexdigest():
+            result = 'corrupt'
+    parent.send('stop')
+    process.join()
+
+    mib = len(data) / (1024 * 1024)
+    metrics = protocol.metrics.summary()
+    return {'test': 'protocol' if mode == 'protocol' else 'copy', 'window': window, 'compression': mode if mode == 'heatshrink' else '-',
+            'kibs': len(data) / 1024 / elapsed if elapsed else 0, 'cpu': cpu / mib, 'retransmits': protocol.errors,
+            'resends': stats['resends'] + stats['timeouts'], 'rtt': '{0}/{1}'.format(metrics['rtt_p50'], metrics['rtt_p99']),
+            'result': result, 'metrics': metrics}
+
+#--------#
+# Checks #
+#--------#
+def check_window(args):
+    # On a lossy link a resend costs a round trip whatever the window, a stall costs a response timeout.
+    # Windowed transfers must come out ahead of stop-and-wait, several runs each even out the luck.
+    options = argparse.Namespace(**dict(vars(args), size = 256, latency = 0.5, corrupt = 0.0005, baud = 0, block = 512, buffer = 512, verbose = False))
+    data = bench_data(options.size * 1024)
+    rates = {}
+    for window in (1, 4):
+        runs = [bench(options, window, 'protocol', data, None) for _ in range(3)]
+        elapsed = sum(len(data) / 1024 / row['kibs'] for row in runs if row['kibs'])
+        rates[window] = len(runs) * len(data) / 1024 / elapsed if elapsed else 0
+        if any(row['result'] != 'ok' for row in runs):
+            return False, 'window {0}: {1}'.format(window, ', '.join(row['result'] for row in runs))
+    return rates[4] > rates[1], 'window 1 {0:.1f} KiB/s, window 4 {1:.1f} KiB/s'.format(rates[1], rates[4])
+
+def check_checksum(args):
+    # build_checksum against checksum() folded over every byte: every length up to 300, then random ones,
+    # random data and all 0xFF for the largest sums, through the plain Python and the numpy path
+    protocol = MarlinBinaryProtocolAsync.Protocol(None, 0, 512, 0, 1000)
+    rng = random.Random(3)
+    lengths = list(range(301)) + [rng.randrange(301, 70000) for _ in range(50)] + [65535 + 8]
+    tested = 0
+    for numpy in (False, True):
+        with numpy_checksum(numpy) as enabled:
+            if numpy and not enabled:
+                continue
+            for length in lengths:
+                for data in (rng.getrandbits(8 * length).to_bytes(length, 'little'), b'\xFF' * length):
+                    # packets are checksummed through memoryview slices of the packet buffer
+                    view = memoryview(bytearray(b'\0' + data))[1:]
+                    if protocol.build_checksum(view) != reference_checksum(protocol, data):
+                        return False, '{0} bytes, numpy {1}'.format(length, enabled)
+                    tested += 1
+    return True, '{0} buffers, numpy {1}'.format(tested, 'tested' if MarlinBinaryProtocol.numpy_exists else 'not installed')
+
+def copy_events(module, source, compression):
+    # The events a copy to a fresh client reports, with the progress they carry
+    firmware = Firmware().start()
+    events = []
+    def on_event(event):
+        events.append((event[0], event[1].source_sent))
+    async def call(result):
+        # the threaded classes return their results, the asyncio ones coroutines
+        return await result if asyncio.iscoroutine(result) else result
+    async def run():
+        protocol = module.Protocol(firmware.path, 115200, 512, 0, 1000)
+        if module is MarlinBinaryProtocolAsync:
+            await protocol.open()
+        await call(protocol.connect())
+        filetransfer = module.FileTransferProtocol(protocol, on_event = on_event)
+        await call(filetransfer.copy(source, 'EVENTS.BIN', compression, False))
+        await call(protocol.disconnect())
+        await call(protocol.shutdown())
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            asyncio.run(run())
+    finally:
+        firmware.stop()
+    return events
+
+def check_events(args):
+    # The threaded and the asyncio FileTransferProtocol report the same events at the same points of a copy
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, 'events.bin')
+        with open(source, 'wb') as f:
+            f.write(bench_data(300 * 1024))
+        for compression in [False] + ([True] if MarlinBinaryProtocol.heatshrink_exists else []):
+            threaded = copy_events(MarlinBinaryProtocol, source, compression)
+            events = copy_events(MarlinBinaryProtocolAsync, source, compression)
+            if events != threaded:
+                return False, 'compression {0}: threaded {1}, asyncio {2}'.format(compression, [e for e, _ in threaded], [e for e, _ in events])
+    progress = sum(1 for event, _ in threaded if event == 'progress')
+    return progress == 11, '{0} events, {1} progress'.format(len(threaded), progress)
+
+class RecordingFirmware(Firmware):
+    # keeps every command it ran
+    def __init__(self, **options):
+        super().__init__(**options)
+        self.executed = []
+
+    def gcode(self, line):
+        self.executed.append(line)
+        super().gcode(line)
+
+def stream_gcode(lines, **options):
+    # The streamer after sending 'lines' to a fresh client, and the commands the client ran without
+    # the streamer's own M110 and M105
+    firmware = RecordingFirmware(**options).start()
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            protocol = MarlinBinaryProtocol.Protocol(firmware.path, 115200, 512, 0, 1000)
+            streamer = MarlinBinaryProtocol.GCodeStreamer(protocol, timeout = 500)
+            try:
+                streamer.stream(lines)
+            finally:
+                protocol.shutdown()
+    finally:
+        firmware.stop()
+    return streamer, firmware, [line for line in firmware.executed if line.split()[0] not in ('M110', 'M105')]
+
+def check_gcode(args):
+    # On a corrupting link every streamed line runs exactly once and in order, and counts as sent. The xor line
+    # checksum misses two flips of the same bit in a line, the low corruption rate and the seed keep that out.
+    rng = random.Random(17)
+    lines = ['G1 X{0:.3f} Y{1:.3f} F1800'.format(rng.random() * 200, rng.random() * 200) for _ in range(1000)]
+    random.seed(17)
+    rejected = resends = 0
+    for options in ({'corrupt': 0.0003}, {'corrupt': 0.0003, 'advanced_ok': True, 'bufsize': 16}):
+        streamer, firmware, executed = stream_gcode(lines, **options)
+        if executed != lines or streamer.lines != len(lines):
+            first = next((i for i, (ran, sent) in enumerate(zip(executed, lines)) if ran != sent), min(len(executed), len(lines)))
+            return False, '{0}: {1} of {2} lines ran, {3} counted, first difference at line {4}'.format(options, len(executed), len(lines), streamer.lines, first + 1)
+        rejected += firmware.stats['line_errors']
+        resends += streamer.resends
+    return rejected > 0, '{0} lines twice, {1} rejected, {2} resends'.format(len(lines), rejected, resends)
+
+checks = {'window': check_window, 'checksum': check_checksum, 'events': check_events, 'gcode': check_gcode}
+
+def check(args):
+    failed = 0
+    for name in args.check or checks:
+        ok, detail = checks[name](args)
+        failed += not ok
+        print('{0:<10} {1}  {2}'.format(name, 'ok' if ok else 'FAILED', detail))
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated Marlin binary file transfer client and protocol benchmarks')
+    parser.add_argument('--serve', action='store_true', help='only run the simulated client and print its pty')
+    parser.add_argument('--size', type=int, default=1024, help='KiB to transfer per test (default=1024)')
+    parser.add_argument('--block', type=int, default=512, help='host block size (default=512)')
+    parser.add_argument('--buffer', type=int, default=512, help='client payload buffer (default=512)')
+    parser.add_argument('--baud', type=int, default=0, help='emulated baud rate, 0 = unthrottled (default=0)')
+    parser.add_argument('--latency', type=float, default=0, help='ms the client needs per packet (default=0)')
+    parser.add_argument('--corrupt', type=float, default=0, help='probability of a corrupted byte (default=0)')
+    parser.add_argument('--timeout', type=int, default=1000, help='host response timeout in ms (default=1000)')
+    parser.add_argument('--adaptive', action='store_true', help='adapt the block size of file copies to the link')
+    parser.add_argument('--window', type=int, nargs='+', default=[1, 8], help='window sizes to test (default=1 8)')
+    parser.add_argument('--checksum', type=float, default=0, help='MiB to checksum per packet size and implementation, instead of the transfers')
+    parser.add_argument('--wait', action='store_true', help='compare CPU time per MiB of queued and sleep-polled response waits, instead of the transfers')
+    parser.add_argument('--lines', type=int, default=0, help='thousand lines for the dispatch line rate test, instead of the transfers')
+    parser.add_argument('--check', nargs='*', choices=sorted(checks), help='run the protocol checks (default=all) instead of the benchmarks')
+    parser.add_argument('--verbose', action='store_true', help='show the protocol output')
+    parser.add_argument('--json', action='store_true', help='print the results with the transfer metrics as JSON, for regression checks')
+    args = parser.parse_args()
+
+    if args.serve:
+        firmware = Firmware(args.buffer, args.baud, args.latency, args.corrupt).start()
+        print('Simulated client on', firmware.path)
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            firmware.stop()
+        return
+
+    if args.check is not None:
+        sys.exit(1 if check(args) else 0)
+
+    if args.checksum:
+        print('{0:<11} {1:>5} {2:>9} {3:>13}'.format('Checksum', 'Bytes', 'MiB/s', 'CPU us/packet'))
+        for row in bench_checksum(args.checksum):
+            print('{test:<11} {size:>5} {mibs:>9.2f} {cpu:>13.2f}'.format(**row))
+        return
+
+    if args.lines:
+        parent, child = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=serve, args=(child, {}), daemon=True)
+        process.start()
+        output = sys.stdout if args.verbose else io.StringIO()
+        with contextlib.redirect_stdout(output):
+            # the asyncio Protocol needs no port until opened, its receive() is the bare dispatcher
+            rows = [bench_lines('dispatch', MarlinBinaryProtocolAsync, MarlinBinaryProtocolAsync.Protocol(None, 0, 512, 0, args.timeout), None, args.lines * 1000)]
+            protocol = MarlinBinaryProtocol.Protocol(parent.recv(), 115200, 512, 0, args.timeout)
+            try:
+                rows.append(bench_lines('serial', MarlinBinaryProtocol, protocol, parent, args.lines * 1000))
+            finally:
+                protocol.shutdown()
+        parent.send('stop')
+        process.join()
+        print('{0:<9} {1:>8} {2:>9} {3:>11} {4:>8}  {5}'.format('Test', 'Lines', 'klines/s', 'CPU us/line', 'Handled', 'Result'))
+        for row in rows:
+            print('{test:<9} {lines:>8} {klines:>9.1f} {cpu:>11.2f} {handled:>8}  {result}'.format(**row))
+        return
+
+    data = bench_data(args.size * 1024)
+    if args.wait:
+        print('{0} KiB, baud {1}, latency {2} ms, corruption {3}'.format(args.size, args.baud or 'unthrottled', args.latency, args.corrupt))
+        print('{0:<9} {1:>6} {2:<6} {3:>9} {4:>10}  {5}'.format('Test', 'Window', 'Wait', 'KiB/s', 'CPU s/MiB', 'Result'))
+        for window in args.window:
+            for wait, protocol_class in (('poll', PollingProtocol), ('queue', MarlinBinaryProtocol.Protocol)):
+                row = bench(args, window, 'protocol', data, None, protocol_class)
+                print('{test:<9} {window:>6} {wait:<6} {kibs:>9.1f} {cpu:>10.3f}  {result}'.format(wait = wait, **row))
+        return
+
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.bench.bin')
+    with open(source, 'wb') as f:
+        f.write(data)
+
+    modes = ['protocol', 'none'] + (['heatshrink'] if MarlinBinaryProtocol.heatshrink_exists else [])
+    rows = []
+    if not args.json:
+        print('{0} KiB, baud {1}, latency {2} ms, corruption {3}'.format(args.size, args.baud or 'unthrottled', args.latency, args.corrupt))
+        print('{0:<9} {1:>6} {2:<11} {3:>9} {4:>10} {5:>11} {6:>8} {7:>9}  {8}'.format('Test', 'Window', 'Compression', 'KiB/s', 'CPU s/MiB', 'Retransmits', 'Resends', 'RTT p50/99', 'Result'))
+    try:
+        for window in args.window:
+            for mode in modes:
+                row = bench(args, window, mode, data, source)
+                rows.append(row)
+                if not args.json:
+                    print('{test:<9} {window:>6} {compression:<11} {kibs:>9.1f} {cpu:>10.3f} {retransmits:>11} {resends:>8} {rtt:>10}  {result}'.format(**row))
+    finally:
+        os.remove(source)
+    if args.json:
+        print(json.dumps(rows, indent=1))
+
+if __name__ == '__main__':
+    main()
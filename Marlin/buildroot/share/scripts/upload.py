@@ -1,8 +1,8 @@
-import argparse, sys, os, time, random, serial
+import sys, os, time, random, glob, asyncio, serial
 from SCons.Script import DefaultEnvironment
 env = DefaultEnvironment()
 
-import MarlinBinaryProtocol
+import MarlinBinaryProtocol, MarlinBinaryProtocolAsync
 
 #-----------------#
 # Upload Callback #
@@ -35,10 +35,18 @@ def Upload(source, target, env):
         debugPrint('OK')
         return portName
 
+    def _GetFleetPorts(env):
+        # 'custom_upload_ports' lists ports (or globs like /dev/ttyUSB*) to flash all at once
+        Ports = []
+        for Pattern in env.GetProjectOption('custom_upload_ports', '').split():
+            for PortName in (sorted(glob.glob(Pattern)) if glob.has_magic(Pattern) else [Pattern]):
+                if PortName not in Ports: Ports.append(PortName)
+        return Ports
+
     #-------------------------#
     # Simple serial functions #
     #-------------------------#
-    def _OpenPort():
+    def _OpenPort(port):
         # Open serial port
         if port.is_open: return
         debugPrint('Opening upload port...')
@@ -46,21 +54,21 @@ def Upload(source, target, env):
         port.reset_input_buffer()
         debugPrint('OK')
 
-    def _ClosePort():
-        # Open serial port
+    def _ClosePort(port):
+        # Close serial port
         if port is None: return
         if not port.is_open: return
         debugPrint('Closing upload port...')
         port.close()
         debugPrint('OK')
 
-    def _Send(data):
+    def _Send(port, data):
         debugPrint(f'>> {data}')
         strdata = bytearray(data, 'utf8') + b'\n'
         port.write(strdata)
         time.sleep(0.010)
 
-    def _Recv():
+    def _Recv(port):
         clean_responses = []
         responses = port.readlines()
         for Resp in responses:
@@ -76,10 +84,10 @@ def Upload(source, target, env):
     #------------------#
     # SDCard functions #
     #------------------#
-    def _CheckSDCard():
+    def _CheckSDCard(port):
         debugPrint('Checking SD card...')
-        _Send('M21')
-        Responses = _Recv()
+        _Send(port, 'M21')
+        Responses = _Recv(port)
         if len(Responses) < 1 or not any('SD card ok' in r for r in Responses):
             raise Exception('Error accessing SD card')
         debugPrint('SD Card OK')
@@ -88,10 +96,10 @@ def Upload(source, target, env):
     #----------------#
     # File functions #
     #----------------#
-    def _GetFirmwareFiles(UseLongFilenames):
+    def _GetFirmwareFiles(port, UseLongFilenames):
         debugPrint('Get firmware files...')
-        _Send(f"M20 F{'L' if UseLongFilenames else ''}")
-        Responses = _Recv()
+        _Send(port, f"M20 F{'L' if UseLongFilenames else ''}")
+        Responses = _Recv(port)
         if len(Responses) < 3 or not any('file list' in r for r in Responses):
             raise Exception('Error getting firmware files')
         debugPrint('OK')
@@ -110,30 +118,181 @@ def Upload(source, target, env):
                 Firmwares.append(FWFile[:FWFile.upper().index('.BIN') + 4])
         return Firmwares
 
-    def _RemoveFirmwareFile(FirmwareFile):
-        _Send(f'M30 /{FirmwareFile}')
-        Responses = _Recv()
+    def _RemoveFirmwareFile(port, FirmwareFile):
+        _Send(port, f'M30 /{FirmwareFile}')
+        Responses = _Recv(port)
         Removed = len(Responses) >= 1 and any('File deleted' in r for r in Responses)
         if not Removed:
             raise Exception(f"Firmware file '{FirmwareFile}' not removed")
         return Removed
 
-    def _RollbackUpload(FirmwareFile):
-        if not rollback: return
-        print(f"Rollback: trying to delete firmware '{FirmwareFile}'...")
-        _OpenPort()
-        # Wait for SD card release
-        time.sleep(1)
-        # Remount SD card
-        _CheckSDCard()
-        print(' OK' if _RemoveFirmwareFile(FirmwareFile) else ' Error!')
-        _ClosePort()
+    def _RemoveOldFirmwares(upload_port):
+        # Init & Open serial port
+        port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
+        try:
+            _OpenPort(port)
+
+            # Check SD card status
+            _CheckSDCard(port)
+
+            # Get firmware files
+            FirmwareFiles = _GetFirmwareFiles(port, marlin_long_filename_host_support)
+            if Debug:
+                for FirmwareFile in FirmwareFiles:
+                    print(f'Found: {FirmwareFile}')
+
+            # Get all 1st level firmware files (to remove)
+            OldFirmwareFiles = _FilterFirmwareFiles(FirmwareFiles[1:len(FirmwareFiles)-2], marlin_long_filename_host_support)   # Skip header and footers of list
+            if len(OldFirmwareFiles) == 0:
+                print(f'{upload_port}: No old firmware files to delete')
+            else:
+                print(f"{upload_port}: Remove {len(OldFirmwareFiles)} old firmware file{'s' if len(OldFirmwareFiles) != 1 else ''}:")
+                for OldFirmwareFile in OldFirmwareFiles:
+                    print(f"{upload_port}:  -Removing- '{OldFirmwareFile}'...")
+                    print(f'{upload_port}:  OK' if _RemoveFirmwareFile(port, OldFirmwareFile) else f'{upload_port}:  Error!')
+        finally:
+            # Close serial
+            _ClosePort(port)
+
+        # Cleanup completed
+        debugPrint('Cleanup completed')
+
+    def _RollbackUpload(upload_port, FirmwareFile):
+        print(f"Rollback: trying to delete firmware '{FirmwareFile}' via '{upload_port}'...")
+        port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
+        try:
+            _OpenPort(port)
+            # Wait for SD card release
+            time.sleep(1)
+            # Remount SD card
+            _CheckSDCard(port)
+            print(' OK' if _RemoveFirmwareFile(port, FirmwareFile) else ' Error!')
+        finally:
+            _ClosePort(port)
+
+    def _CheckUploadedFile(upload_port, FirmwareFile, FileSize, Reset):
+        # The binary protocol can't read files back, a resumed transfer is checked by the size the
+        # SD card listing reports (lines are '<8.3 name> <size>[ <long name>]') before it is flashed
+        print(f"Checking resumed upload of '{FirmwareFile}'...")
+        port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
+        try:
+            _OpenPort(port)
+            _CheckSDCard(port)
+            Listing = MarlinBinaryProtocol.parse_listing(_GetFirmwareFiles(port, marlin_long_filename_host_support))
+            Size = next((Size for Name, Size in Listing.items() if Name.upper() == FirmwareFile.upper()), None)
+            Verified = Size == FileSize
+            print(' OK' if Verified else f' Error! {Size} bytes on the SD card, {FileSize} expected')
+            if Verified and Reset:
+                print('Trigger firmware update...')
+                _Send(port, 'M997')
+            return Verified
+        finally:
+            _ClosePort(port)
+
+    #---------------------#
+    # Fleet upload        #
+    #---------------------#
+    async def _FleetUploadPort(upload_port, images, result):
+        # The whole update sequence for one board, boards run concurrently on one event loop.
+        # The blocking SD card helpers run on worker threads.
+        loop = asyncio.get_running_loop()
+        start_time = time.time()
+        protocol = None
+        rollback = False
+        try:
+            result['status'] = 'Cleanup'
+            if upload_delete_old_bins:
+                await loop.run_in_executor(None, _RemoveOldFirmwares, upload_port)
+
+            result['status'] = 'Transfer'
+            protocol = MarlinBinaryProtocolAsync.Protocol(upload_port, upload_speed, upload_blocksize, float(upload_error_ratio), int(upload_timeout), int(upload_window))
+            await protocol.open()
+            await protocol.connect()
+            # Mark the rollback (delete broken transfer) from this point on
+            rollback = True
+            filetransfer = MarlinBinaryProtocolAsync.FileTransferProtocol(protocol, adaptive = upload_adaptive)
+            transferOK = await filetransfer.copy(upload_firmware_source_path, upload_firmware_target_name, upload_compression, upload_test, cache = images)
+            result['metrics'] = filetransfer.metrics.summary()
+            await protocol.disconnect()
+
+            # Notify upload completed, wait for SD card release and remount it
+            await protocol.send_ascii('M117 Firmware uploaded' if transferOK else 'M117 Firmware upload failed')
+            await asyncio.sleep(1)
+            await protocol.send_ascii('M21')
+
+            # Trigger firmware update, a resumed transfer only after its size was checked
+            resumed = transferOK and filetransfer.resumes and not upload_test
+            if transferOK and upload_reset and not resumed:
+                result['status'] = 'Reset'
+                await protocol.send_ascii('M997', True)
+            await protocol.shutdown()
+            protocol = None
+            if resumed:
+                result['status'] = 'Check'
+                transferOK = await loop.run_in_executor(None, _CheckUploadedFile, upload_port, upload_firmware_target_name, os.path.getsize(upload_firmware_source_path), upload_reset)
+
+            rollback = not transferOK
+            result['status'] = 'Updated' if transferOK else 'Failed'
+            result['message'] = '' if transferOK else 'Transfer failed'
+
+        except (asyncio.CancelledError, KeyboardInterrupt):
+            result['status'] = 'Failed'
+            result['message'] = 'Interrupted'
+            raise
+        except Exception as ex:
+            result['status'] = 'Failed'
+            result['message'] = str(ex) or type(ex).__name__
+        finally:
+            # A failed or interrupted board is never left with a half-written firmware
+            if protocol:
+                try:
+                    await protocol.disconnect()
+                except Exception:
+                    pass
+                await protocol.shutdown()
+            if rollback:
+                try:
+                    await loop.run_in_executor(None, _RollbackUpload, upload_port, upload_firmware_target_name)
+                except Exception as rex:
+                    result['message'] += f' (rollback failed: {rex})'
+            result['time'] = time.time() - start_time
+
+    def _FleetUpload(upload_ports, images):
+        # Every board of the fleet shares the compressed image once it is in the cache
+        results = { upload_port : { 'status': 'Waiting', 'message': '', 'time': 0, 'metrics': None } for upload_port in upload_ports }
+
+        async def _Run():
+            # A board that fails only fails itself. Anything escaping one (an interrupt, a bug) stops the others,
+            # they roll back their transfers before it is raised
+            tasks = [asyncio.ensure_future(_FleetUploadPort(upload_port, images, results[upload_port])) for upload_port in upload_ports]
+            try:
+                await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                outcomes = await asyncio.gather(*tasks, return_exceptions=True)
+            errors = sorted((outcome for outcome in outcomes if isinstance(outcome, BaseException)), key=lambda error: isinstance(error, asyncio.CancelledError))
+            if errors:
+                raise errors[0]
+        asyncio.run(_Run())
+
+        # Summary, the link figures single out slow or noisy connections
+        Width = max(len(upload_port) for upload_port in upload_ports)
+        print('')
+        print(f"{'Port':<{Width}}  Result   Time      KiB/s  Resends Timeouts  RTT ms p50/99  Message")
+        for upload_port in upload_ports:
+            result = results[upload_port]
+            metrics = result['metrics'] or { 'kibs': 0, 'resends': '-', 'timeouts': '-', 'rtt_p50': '-', 'rtt_p99': '-' }
+            rtt = f"{metrics['rtt_p50']}/{metrics['rtt_p99']}"
+            print(f"{upload_port:<{Width}}  {result['status']:<7} {result['time']:6.1f}s {metrics['kibs']:8.1f} {metrics['resends']:>8} {metrics['timeouts']:>8} {rtt:>14}  {result['message']}")
+        Updated = sum(1 for result in results.values() if result['status'] == 'Updated')
+        print(f'Firmware updated on {Updated} of {len(upload_ports)} boards')
+        return 0 if Updated == len(upload_ports) else -1
 
 
     #---------------------#
     # Callback Entrypoint #
     #---------------------#
-    port = None
     protocol = None
     filetransfer = None
     rollback = False
@@ -156,17 +315,23 @@ def Upload(source, target, env):
                                                     # Source firmware filename
     upload_speed = env['UPLOAD_SPEED'] if 'UPLOAD_SPEED' in env else 115200
                                                     # baud rate of serial connection
-    upload_port = _GetUploadPort(env)               # Serial port to use
+    upload_ports = _GetFleetPorts(env)              # Serial ports of a fleet upload
+    upload_port = _GetUploadPort(env) if not upload_ports else None
+                                                    # Serial port to use
 
     # Set local upload params
     upload_firmware_target_name = os.path.basename(upload_firmware_source_path)
                                                     # Target firmware filename
     upload_timeout = 1000                           # Communication timout, lossy/slow connections need higher values
     upload_blocksize = 512                          # Transfer block size. 512 = Autodetect
+    upload_window = 1                               # Packets in flight. 1 = Stop-and-wait, raise only for flow controlled (USB) links
+    upload_adaptive = False                         # Measure which block size gets the most through a noisy link
     upload_compression = True                       # Enable compression
     upload_error_ratio = 0                          # Simulated corruption ratio
     upload_test = False                             # Benchmark the serial link without storing the file
     upload_reset = True                             # Trigger a soft reset for firmware update after the upload
+    upload_cache_dir = os.path.join(env['PROJECT_BUILD_DIR'], 'heatshrink') if 'PROJECT_BUILD_DIR' in env else None
+                                                    # Compressed images of previous uploads. None = Compress every upload
 
     # Set local upload params based on board type to change script behavior
     # "upload_delete_old_bins": delete all *.bin files in the root of SD Card
@@ -194,7 +359,7 @@ def Upload(source, target, env):
     try:
 
         # Start upload job
-        print(f"Uploading firmware '{os.path.basename(upload_firmware_target_name)}' to '{marlin_motherboard}' via '{upload_port}'")
+        print(f"Uploading firmware '{os.path.basename(upload_firmware_target_name)}' to '{marlin_motherboard}' via '{', '.join(upload_ports) if upload_ports else upload_port}'")
 
         # Dump some debug info
         if Debug:
@@ -213,13 +378,16 @@ def Upload(source, target, env):
             print('---- Upload parameters ------------------------')
             print(f' Source                      : {upload_firmware_source_path}')
             print(f' Target                      : {upload_firmware_target_name}')
-            print(f' Port                        : {upload_port} @ {upload_speed} baudrate')
+            print(f" Port                        : {', '.join(upload_ports) if upload_ports else upload_port} @ {upload_speed} baudrate")
             print(f' Timeout                     : {upload_timeout}')
             print(f' Block size                  : {upload_blocksize}')
+            print(f' Window                      : {upload_window}')
+            print(f' Adaptive block size         : {upload_adaptive}')
             print(f' Compression                 : {upload_compression}')
             print(f' Error ratio                 : {upload_error_ratio}')
             print(f' Test                        : {upload_test}')
             print(f' Reset                       : {upload_reset}')
+            print(f' Compression cache           : {upload_cache_dir}')
             print('-----------------------------------------------')
 
         # Custom implementations based on board parameters
@@ -228,52 +396,33 @@ def Upload(source, target, env):
             upload_firmware_target_name = f"fw-{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789', k=5))}.BIN"
             print(f"Board {marlin_motherboard}: Overriding firmware filename to '{upload_firmware_target_name}'")
 
-        # Delete all *.bin files on the root of SD Card (if flagged)
-        if upload_delete_old_bins:
-            # CUSTOM_FIRMWARE_UPLOAD is needed for this feature
-            if not marlin_custom_firmware_upload:
-                raise Exception(f"CUSTOM_FIRMWARE_UPLOAD must be enabled in 'Configuration_adv.h' for '{marlin_motherboard}'")
+        # CUSTOM_FIRMWARE_UPLOAD is needed to delete old *.bin files
+        if upload_delete_old_bins and not marlin_custom_firmware_upload:
+            raise Exception(f"CUSTOM_FIRMWARE_UPLOAD must be enabled in 'Configuration_adv.h' for '{marlin_motherboard}'")
 
-            # Init & Open serial port
-            port = serial.Serial(upload_port, baudrate = upload_speed, write_timeout = 0, timeout = 0.1)
-            _OpenPort()
+        # Compressed images are reused while the firmware is unchanged. A new image is compressed while it
+        # is sent and kept for the next upload, without a cache directory every upload does that
+        images = MarlinBinaryProtocol.CompressionCache(upload_cache_dir) if upload_cache_dir else None
 
-            # Check SD card status
-            _CheckSDCard()
+        # Update every board of the fleet concurrently, they share one image, in memory without a cache directory
+        if upload_ports:
+            return _FleetUpload(upload_ports, images or MarlinBinaryProtocol.CompressionCache(None))
 
-            # Get firmware files
-            FirmwareFiles = _GetFirmwareFiles(marlin_long_filename_host_support)
-            if Debug:
-                for FirmwareFile in FirmwareFiles:
-                    print(f'Found: {FirmwareFile}')
-
-            # Get all 1st level firmware files (to remove)
-            OldFirmwareFiles = _FilterFirmwareFiles(FirmwareFiles[1:len(FirmwareFiles)-2], marlin_long_filename_host_support)   # Skip header and footers of list
-            if len(OldFirmwareFiles) == 0:
-                print('No old firmware files to delete')
-            else:
-                print(f"Remove {len(OldFirmwareFiles)} old firmware file{'s' if len(OldFirmwareFiles) != 1 else ''}:")
-                for OldFirmwareFile in OldFirmwareFiles:
-                    print(f" -Removing- '{OldFirmwareFile}'...")
-                    print(' OK' if _RemoveFirmwareFile(OldFirmwareFile) else ' Error!')
-
-            # Close serial
-            _ClosePort()
-
-            # Cleanup completed
-            debugPrint('Cleanup completed')
+        # Delete all *.bin files on the root of SD Card (if flagged)
+        if upload_delete_old_bins:
+            _RemoveOldFirmwares(upload_port)
 
         # WARNING! The serial port must be closed here because the serial transfer that follow needs it!
 
         # Upload firmware file
         debugPrint(f"Copy '{upload_firmware_source_path}' --> '{upload_firmware_target_name}'")
-        protocol = MarlinBinaryProtocol.Protocol(upload_port, upload_speed, upload_blocksize, float(upload_error_ratio), int(upload_timeout))
+        protocol = MarlinBinaryProtocol.Protocol(upload_port, upload_speed, upload_blocksize, float(upload_error_ratio), int(upload_timeout), int(upload_window))
         #echologger = MarlinBinaryProtocol.EchoProtocol(protocol)
         protocol.connect()
         # Mark the rollback (delete broken transfer) from this point on
         rollback = True
-        filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol)
-        transferOK = filetransfer.copy(upload_firmware_source_path, upload_firmware_target_name, upload_compression, upload_test)
+        filetransfer = MarlinBinaryProtocol.FileTransferProtocol(protocol, adaptive = upload_adaptive)
+        transferOK = filetransfer.copy(upload_firmware_source_path, upload_firmware_target_name, upload_compression, upload_test, cache = images)
         protocol.disconnect()
 
         # Notify upload completed
@@ -288,7 +437,12 @@ def Upload(source, target, env):
         # Transfer failed?
         if not transferOK:
             protocol.shutdown()
-            _RollbackUpload(upload_firmware_target_name)
+            _RollbackUpload(upload_port, upload_firmware_target_name)
+        elif filetransfer.resumes and not upload_test:
+            # Only flash a resumed transfer once its size was checked
+            protocol.shutdown()
+            transferOK = _CheckUploadedFile(upload_port, upload_firmware_target_name, os.path.getsize(upload_firmware_source_path), upload_reset)
+            if not transferOK: _RollbackUpload(upload_port, upload_firmware_target_name)
         else:
             # Trigger firmware update
             if upload_reset:
@@ -305,8 +459,7 @@ def Upload(source, target, env):
         if protocol:
             protocol.disconnect()
             protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
+        if rollback: _RollbackUpload(upload_port, upload_firmware_target_name)
         raise
 
     except serial.SerialException as se:
@@ -315,8 +468,7 @@ def Upload(source, target, env):
         if protocol:
             protocol.disconnect()
             protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
+        if rollback: _RollbackUpload(upload_port, upload_firmware_target_name)
         raise Exception(se)
 
     except MarlinBinaryProtocol.FatalError:
@@ -324,8 +476,7 @@ def Upload(source, target, env):
         if protocol:
             protocol.disconnect()
             protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
+        if rollback: _RollbackUpload(upload_port, upload_firmware_target_name)
         raise
 
     except Exception as ex:
@@ -333,8 +484,7 @@ def Upload(source, target, env):
         if protocol:
             protocol.disconnect()
             protocol.shutdown()
-        _RollbackUpload(upload_firmware_target_name)
-        _ClosePort()
+        if rollback: _RollbackUpload(upload_port, upload_firmware_target_name)
         print('Firmware not updated')
         raise
 